@@ -0,0 +1,284 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Generate a large ledger (data managers, data samples, objectives, algos and compute plans of traintuples)
+# for benchmarking the peers and their state database, e.g.
+#   python3 generate_ledger.py --data-samples 100000 --traintuples 10000 --plan-depth 10 --rate 200
+# or only write the generated fixtures, to load them later with a fixtures script:
+#   python3 generate_ledger.py --traintuples 1000 --output /substra/data/ledger.json
+
+import argparse
+import json
+import os
+import random
+import time
+from collections import Counter
+
+from yaml import dump
+
+from utils.benchmark_utils import percentile
+from utils.cli import init_cli
+from utils.config_utils import load_conf_index, load_confs
+from utils.fixtures_utils import load_fixtures, prepare_fixtures
+
+
+def permissions():
+    return {
+        'process': {
+            'public': True,
+            'authorizedIDs': []
+        }
+    }
+
+
+def zipf_weights(n, skew):
+    # a few assets are used a lot, most of them rarely
+    return [1 / (k + 1) ** skew for k in range(n)]
+
+
+def random_hash(rng):
+    return '%064x' % rng.getrandbits(256)
+
+
+def backend(org):
+    return f"http://{org.replace('-', '')}.substra-backend:8000"
+
+
+def generate(orgs, datamanagers=10, data_samples=1000, samples_per_tx=100, objectives=2, test_samples=10,
+             algos=10, traintuples=100, samples_per_traintuple=10, plan_depth=5, plan_width=1, skew=1.1, seed=0):
+    rng = random.Random(seed)
+    fixtures = {}
+
+    # data managers, spread over orgs
+    for i in range(datamanagers):
+        org = orgs[i % len(orgs)]
+        opener_hash = random_hash(rng)
+        fixtures[f'datamanager_{i}'] = {
+            'fcn': 'registerDataManager',
+            'org': org,
+            'args': {
+                'name': f'Dataset {i}',
+                'openerHash': opener_hash,
+                'openerStorageAddress': f'{backend(org)}/dataset/{opener_hash}/opener/',
+                'type': 'Images',
+                'descriptionHash': random_hash(rng),
+                'descriptionStorageAddress': f'{backend(org)}/dataset/{opener_hash}/description/',
+                'objectiveKey': '',
+                'permissions': permissions()
+            },
+            'key': 'key',
+        }
+
+    # train data samples, most of them in a few data managers, registered by batches
+    sample_datamanagers = Counter(rng.choices(range(datamanagers), weights=zipf_weights(datamanagers, skew),
+                                              k=data_samples))
+    samples = {i: [] for i in range(datamanagers)}
+    for i in range(datamanagers):
+        hashes = [random_hash(rng) for _ in range(sample_datamanagers[i])]
+        for b in range(0, len(hashes), samples_per_tx):
+            name = f'data_samples_{i}_{b // samples_per_tx}'
+            fixtures[name] = {
+                'fcn': 'registerDataSample',
+                'org': orgs[i % len(orgs)],
+                'args': {
+                    'hashes': hashes[b:b + samples_per_tx],
+                    'dataManagerKeys': [f'$datamanager_{i}'],
+                    'testOnly': 'false'
+                },
+                'key': 'keys',
+            }
+            samples[i] += [(h, name) for h in hashes[b:b + samples_per_tx]]
+
+    # objectives with their own test data samples
+    for o in range(objectives):
+        i = o % datamanagers
+        org = orgs[i % len(orgs)]
+        fixtures[f'test_data_samples_{o}'] = {
+            'fcn': 'registerDataSample',
+            'org': org,
+            'args': {
+                'hashes': [random_hash(rng) for _ in range(test_samples)],
+                'dataManagerKeys': [f'$datamanager_{i}'],
+                'testOnly': 'true'
+            },
+            'key': 'keys',
+        }
+        description_hash = random_hash(rng)
+        fixtures[f'objective_{o}'] = {
+            'fcn': 'registerObjective',
+            'org': org,
+            'args': {
+                'name': f'Objective {o}',
+                'descriptionHash': description_hash,
+                'descriptionStorageAddress': f'{backend(org)}/objective/{description_hash}/description/',
+                'metricsName': 'macro-average recall',
+                'metricsHash': random_hash(rng),
+                'metricsStorageAddress': f'{backend(org)}/objective/{description_hash}/metrics/',
+                'testDataset': {
+                    'dataManagerKey': f'$datamanager_{i}',
+                    'dataSampleKeys': f'$test_data_samples_{o}',
+                },
+                'permissions': permissions()
+            },
+            'key': 'key',
+        }
+
+    for a in range(algos):
+        org = rng.choice(orgs)
+        algo_hash = random_hash(rng)
+        fixtures[f'algo_{a}'] = {
+            'fcn': 'registerAlgo',
+            'org': org,
+            'args': {
+                'name': f'Algo {a}',
+                'hash': algo_hash,
+                'storageAddress': f'{backend(org)}/algo/{algo_hash}/file/',
+                'descriptionHash': random_hash(rng),
+                'descriptionStorageAddress': f'{backend(org)}/algo/{algo_hash}/description/',
+                'permissions': permissions()
+            },
+            'key': 'key',
+        }
+
+    # compute plans: plan_depth levels of plan_width traintuples, each one training on the models of the previous level
+    datamanager_weights = [w if samples[i] else 0 for i, w in enumerate(zipf_weights(datamanagers, skew))]
+    algo_weights = zipf_weights(algos, skew)
+    created = 0
+    plan = 0
+    while created < traintuples:
+        previous_level = []
+        for level in range(plan_depth):
+            current_level = []
+            for j in range(plan_width):
+                if created == traintuples:
+                    break
+
+                i = rng.choices(range(datamanagers), weights=datamanager_weights)[0]
+                train_samples = rng.sample(samples[i], min(samples_per_traintuple, len(samples[i])))
+                in_models = previous_level if len(previous_level) <= 2 else rng.sample(previous_level, 2)
+
+                name = f'traintuple_{plan}_{level}_{j}'
+                fixtures[name] = {
+                    'fcn': 'createTraintuple',
+                    'org': orgs[i % len(orgs)],
+                    'deps': sorted({batch for _, batch in train_samples}),
+                    'args': {
+                        'algoKey': f'$algo_{rng.choices(range(algos), weights=algo_weights)[0]}',
+                        'objectiveKey': f'$objective_{rng.randrange(objectives)}',
+                        'inModels': [f'${in_model}' for in_model in in_models],
+                        'dataManagerKey': f'$datamanager_{i}',
+                        'dataSampleKeys': [h for h, _ in train_samples],
+                        'flTask': '',
+                        'rank': '',
+                        'tag': f'plan {plan}'
+                    },
+                    'key': 'key',
+                    'default_from': 'tkey',
+                }
+                current_level.append(name)
+                created += 1
+            previous_level = current_level
+        plan += 1
+
+    return fixtures
+
+
+def make_report(fixtures, results, elapsed):
+    report = {'elapsed': elapsed, 'transactions': len(fixtures), 'functions': {}}
+
+    for status in ('done', 'failed', 'skipped'):
+        report[status] = sum(result['status'] == status for result in results.values())
+    # done includes transactions rejected because their asset already exists, which never reached the orderer
+    report['committed'] = sum(result['committed'] for result in results.values())
+    report['tps'] = report['committed'] / elapsed if elapsed else 0
+
+    for fcn in sorted({fixture['fcn'] for fixture in fixtures.values()}):
+        latencies = [results[name]['elapsed'] for name, fixture in fixtures.items()
+                     if fixture['fcn'] == fcn and results[name]['committed']]
+        report['functions'][fcn] = {
+            'committed': len(latencies),
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p90': percentile(latencies, 0.9),
+            'latency_p99': percentile(latencies, 0.99),
+        }
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orgs', nargs='+', type=str, default=None,
+                        help='orgs registering assets, default: all client orgs of the network')
+    parser.add_argument('--datamanagers', type=int, default=10)
+    parser.add_argument('--data-samples', type=int, default=1000, help='number of train data samples')
+    parser.add_argument('--samples-per-tx', type=int, default=100, help='data samples registered per transaction')
+    parser.add_argument('--objectives', type=int, default=2)
+    parser.add_argument('--test-samples', type=int, default=10, help='test data samples per objective')
+    parser.add_argument('--algos', type=int, default=10)
+    parser.add_argument('--traintuples', type=int, default=100)
+    parser.add_argument('--samples-per-traintuple', type=int, default=10)
+    parser.add_argument('--plan-depth', type=int, default=5, help='levels of traintuples per compute plan')
+    parser.add_argument('--plan-width', type=int, default=1, help='traintuples per compute plan level')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='zipf exponent of the use of data managers and algos, 0 for uniform')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='default: random, a seed already loaded on the network only generates assets that'
+                             ' exist already and are rejected')
+    parser.add_argument('--rate', type=float, default=None, help='maximum submitted transactions per second')
+    parser.add_argument('--max-in-flight', type=int, default=100, help='maximum pending transactions per org')
+    parser.add_argument('--output', type=str, default=None,
+                        help='only write the generated fixtures to this yaml or json file')
+    parser.add_argument('--report', type=str, default=None, help='write a json report of the load to this file')
+    args = vars(parser.parse_args())
+
+    if args['traintuples'] and not (args['data_samples'] and args['objectives'] and args['algos']):
+        parser.error('traintuples need data samples, objectives and algos')
+    if args['objectives'] > args['datamanagers']:
+        parser.error('objectives need a data manager each, a data manager has a single objective')
+    if args['plan_depth'] < 1 or args['plan_width'] < 1:
+        parser.error('compute plans need at least one level of one traintuple')
+
+    index = load_conf_index()
+    orgs = args.pop('orgs') or [name for name, org in index['orgs'].items() if org['type'] == 'client']
+    options = {name: args.pop(name) for name in ('rate', 'max_in_flight', 'output', 'report')}
+    if args['seed'] is None:
+        args['seed'] = random.randrange(2 ** 32)
+
+    fixtures = generate(orgs, **args)
+    print(f"Generated {len(fixtures)} transactions with seed {args['seed']}", flush=True)
+
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            if os.path.splitext(options['output'])[1] == '.json':
+                json.dump({'fixtures': fixtures}, f)
+            else:
+                dump({'fixtures': fixtures}, f, default_flow_style=False)
+    else:
+        fixtures = prepare_fixtures(fixtures, index['orgs'], index['peers'])
+
+        cli = init_cli()
+        misc = load_confs('orderer')[0]['misc']
+        channel_name, chaincode_name = misc['channel_name'], misc['chaincode_name']
+        cli.new_channel(channel_name)
+
+        start = time.time()
+        _, results = load_fixtures(cli, fixtures, channel_name, chaincode_name, max_in_flight=options['max_in_flight'],
+                                   rate=options['rate'], report_interval=10, verbose=False)
+        report = make_report(fixtures, results, time.time() - start)
+        report['seed'] = args['seed']
+        print(json.dumps(report, indent=4), flush=True)
+
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=4)
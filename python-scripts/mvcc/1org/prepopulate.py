@@ -12,66 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
-import glob
 import json
 import os
 
 from utils.cli import init_cli
+from utils.invoke_utils import ChaincodeClient, retry_stats
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
 
 
-def queryChaincode(fcn, args, org_name, peers):
-    print(f"Query chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_query(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-    ))
-
-    return response
-
-
-def invokeChainCode(fcn, args, org_name, peers):
-    print(f"Invoke chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_invoke(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-        wait_for_event=True
-    ))
-
-    try:
-        res = json.loads(response)
-    except:
-        res = response
-    finally:
-        print(res)
-        return res
-
-
 def setup():
 
-    res = queryChaincode('queryObjectives', None, 'owkin', [cli.get_peer('peer1-owkin')])
+    res = owkin.run(owkin.query('queryObjectives', None))
     print(res)
 
     fcn = 'registerDataManager'
@@ -85,7 +37,7 @@ def setup():
         'objectiveKey': '',
         'permissions': 'all'
     }
-    datamanager_owkin = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    datamanager_owkin = owkin.run(owkin.invoke(fcn, args))
 
     if 'key' in datamanager_owkin:
         datamanager_owkin_key = datamanager_owkin['key']
@@ -93,8 +45,7 @@ def setup():
     else:
         datamanager_owkin_key = 'ccbaa3372bc74bce39ce3b138f558b3a7558958ef2f244576e18ed75b0cea994'
 
-    res = queryChaincode('queryDataset', [json.dumps({'key': datamanager_owkin_key})], 'owkin',
-                         [cli.get_peer('peer1-owkin')])
+    res = owkin.run(owkin.query('queryDataset', {'key': datamanager_owkin_key}))
     print(res)
 
     # register train data on dataset chu nantes (will take dataset creator as worker)
@@ -104,7 +55,7 @@ def setup():
         'dataManagerKeys': datamanager_owkin_key,
         'testOnly': json.dumps(False)
     }
-    data_samples = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    data_samples = owkin.run(owkin.invoke(fcn, args))
 
     if 'keys' in data_samples:
         data_owkin_train_keys_1 = data_samples['keys']
@@ -121,7 +72,7 @@ def setup():
         'dataManagerKeys': datamanager_owkin_key,
         'testOnly': json.dumps(True)
     }
-    data_samples = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    data_samples = owkin.run(owkin.invoke(fcn, args))
 
     if 'keys' in data_samples:
         data_owkin_test_keys_1 = data_samples['keys']
@@ -142,7 +93,7 @@ def setup():
         'testDataset': f'{datamanager_owkin_key}:{", ".join(data_owkin_test_keys_1)}',
         'permissions': 'all'
     }
-    objective_owkin = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    objective_owkin = owkin.run(owkin.invoke(fcn, args))
     if 'key' in objective_owkin:
         objective_owkin_key = objective_owkin['key']
     # debugging purposes
@@ -159,7 +110,7 @@ def setup():
         'descriptionStorageAddress': 'http://owkin.substra-backend:8001/algo/9ca7ffbdbb55156b0fb44a227c3c305b7f7300113b6008c662460cf0f8f7cc3a/description/',
         'permissions': 'all'
     }
-    algo_owkin_1 = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    algo_owkin_1 = owkin.run(owkin.invoke(fcn, args))
     if 'key' in algo_owkin_1:
         algo_owkin_1_key = algo_owkin_1['key']
     # debugging purposes
@@ -167,10 +118,10 @@ def setup():
         algo_owkin_1_key = '9ca7ffbdbb55156b0fb44a227c3c305b7f7300113b6008c662460cf0f8f7cc3a'
 
     # query data of the dataset in chu nantes
-    res = queryChaincode('queryDataManagers', [], 'owkin', [cli.get_peer('peer1-owkin')])
+    res = owkin.run(owkin.query('queryDataManagers', []))
     print(res)
 
-    res = queryChaincode('queryTraintuples', [], 'owkin', [cli.get_peer('peer1-owkin')])
+    res = owkin.run(owkin.query('queryTraintuples', []))
     print(res)
 
     # create parent traintuple
@@ -185,7 +136,7 @@ def setup():
         'rank': '',
         'tag': 'foo'
     }
-    traintuple = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    traintuple = owkin.run(owkin.invoke(fcn, args))
 
     if isinstance(traintuple, dict) and 'key' in traintuple:
         traintuple_key = traintuple['key']
@@ -197,14 +148,9 @@ def setup():
 
 
 if __name__ == "__main__":
-    files = glob.glob(f'{SUBSTRA_PATH}/conf/config/conf-*.json')
-    files.sort(key=os.path.getmtime)
-    orgs = [json.load(open(file_path, 'r')) for file_path in files]
-
-    cli = init_cli(orgs)
-
-    # add channel on cli
-    channel_name = orgs[0]['misc']['channel_name']
-    cli.new_channel(channel_name)
+    cli = init_cli()
+    owkin = ChaincodeClient(cli, 'owkin', verbose=True)
 
     setup()
+    retry_stats.print()
+    owkin.close()
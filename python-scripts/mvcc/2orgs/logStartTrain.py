@@ -12,84 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
-import glob
-import json
 import os
 import time
 
 
 from utils.cli import init_cli
+from utils.invoke_utils import ChaincodeClient, retry_stats
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
 
 
-def queryChaincode(fcn, args, org_name, peers):
-    print(f"Query chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_query(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-    ))
-
-    return response
-
-
-def invokeChainCode(fcn, args, org_name, peers):
-    print(f"Invoke chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_invoke(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-        wait_for_event=True
-    ))
-
-    try:
-        res = json.loads(response)
-    except:
-        res = response
-    finally:
-        print(res)
-        return res
-
-
 def run():
 
-    res = json.loads(queryChaincode('queryTraintuples', [], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')]))
+    res = chunantes.run(chunantes.query('queryTraintuples', []))
     traintuple_key = res[len(res) - 1]['key']  # get oldest
     time.sleep(0.5)
-    args = [json.dumps({'key': traintuple_key})]
+    args = {'key': traintuple_key}
     print(f'logStartTrain traintuple with key {traintuple_key}', flush=True)
-    invokeChainCode('logStartTrain', args, 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    chunantes.run(chunantes.invoke('logStartTrain', args))
 
 
 if __name__ == "__main__":
-    files = glob.glob(f'{SUBSTRA_PATH}/conf/config/conf-*.json')
-    files.sort(key=os.path.getmtime)
-    orgs = [json.load(open(file_path, 'r')) for file_path in files]
-
-    cli = init_cli(orgs)
-
-    # add channel on cli
-    channel_name = orgs[0]['misc']['channel_name']
-    cli.new_channel(channel_name)
+    cli = init_cli()
+    chunantes = ChaincodeClient(cli, 'chu-nantes', verbose=True)
 
     run()
+    retry_stats.print()
+    chunantes.close()
@@ -12,63 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
-import glob
 import json
 import os
 
 from utils.cli import init_cli
+from utils.invoke_utils import ChaincodeClient, retry_stats
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
 
 
-def queryChaincode(fcn, args, org_name, peers):
-    print(f"Query chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_query(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-    ))
-
-    return response
-
-
-def invokeChainCode(fcn, args, org_name, peers):
-    print(f"Invoke chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_invoke(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-        wait_for_event=True
-    ))
-
-    try:
-        res = json.loads(response)
-    except:
-        res = response
-    finally:
-        print(res)
-        return res
-
-
 def setup():
     ''''''
     '''
@@ -79,7 +31,7 @@ def setup():
            \___/ \_/\_/ |_|\_\_|_| |_|
     '''
 
-    res = queryChaincode('queryObjectives', None, 'owkin', [cli.get_peer('peer1-owkin')])
+    res = owkin.run(owkin.query('queryObjectives', None))
     print(res)
 
     '''
@@ -102,7 +54,7 @@ def setup():
         'objectiveKey': '',
         'permissions': 'all'
     }
-    datamanager_chunantes = invokeChainCode(fcn, [json.dumps(args)], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    datamanager_chunantes = chunantes.run(chunantes.invoke(fcn, args))
 
     if 'key' in datamanager_chunantes:
         datamanager_chunantes_key = datamanager_chunantes['key']
@@ -110,8 +62,7 @@ def setup():
     else:
         datamanager_chunantes_key = 'ccbaa3372bc74bce39ce3b138f558b3a7558958ef2f244576e18ed75b0cea994'
 
-    res = queryChaincode('queryDataset', [json.dumps({'key': datamanager_chunantes_key})], 'chu-nantes',
-                         [cli.get_peer('peer1-chu-nantes')])
+    res = chunantes.run(chunantes.query('queryDataset', {'key': datamanager_chunantes_key}))
     print(res)
 
     # register train data on dataset chu nantes (will take dataset creator as worker)
@@ -121,7 +72,7 @@ def setup():
         'dataManagerKeys': datamanager_chunantes_key,
         'testOnly': json.dumps(False)
     }
-    data_samples = invokeChainCode(fcn, [json.dumps(args)], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    data_samples = chunantes.run(chunantes.invoke(fcn, args))
 
     if 'keys' in data_samples:
         data_chunantes_train_keys_1 = data_samples['keys']
@@ -136,7 +87,7 @@ def setup():
         'dataManagerKeys': datamanager_chunantes_key,
         'testOnly': json.dumps(True)
     }
-    data_keys = invokeChainCode(fcn, [json.dumps(args)], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    data_keys = chunantes.run(chunantes.invoke(fcn, args))
 
     if 'keys' in data_keys:
         data_chunantes_test_keys_1 = data_keys['keys']
@@ -165,7 +116,7 @@ def setup():
         'objectiveKey': '',
         'permissions': 'all'
     }
-    datamanager_owkin = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    datamanager_owkin = owkin.run(owkin.invoke(fcn, args))
 
     if 'key' in datamanager_owkin:
         datamanager_owkin_key = datamanager_owkin['key']
@@ -180,7 +131,7 @@ def setup():
         'dataManagerKeys': datamanager_owkin_key,
         'testOnly': json.dumps(True)
     }
-    data_keys = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    data_keys = owkin.run(owkin.invoke(fcn, args))
 
     # register train data on datamanager_owkin
     args = {
@@ -188,7 +139,7 @@ def setup():
         'dataManagerKeys': datamanager_owkin_key,
         'testOnly': json.dumps(False)
     }
-    data_keys = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    data_keys = owkin.run(owkin.invoke(fcn, args))
 
     # register test data on datamanager_owkin
     args = {
@@ -196,9 +147,9 @@ def setup():
         'dataManagerKeys': datamanager_owkin_key,
         'testOnly': json.dumps(True)
     }
-    data_keys = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    data_keys = owkin.run(owkin.invoke(fcn, args))
 
-    res = queryChaincode('queryDataManagers', [], 'owkin', [cli.get_peer('peer1-owkin')])
+    res = owkin.run(owkin.query('queryDataManagers', []))
     print(res)
 
     # create objective
@@ -213,7 +164,7 @@ def setup():
         'testDataset': f'{datamanager_owkin_key}:2d0f943aa81a9cb3fe84b162559ce6aff068ccb04e0cb284733b8f9d7e06517e, 533ee6e7b9d8b247e7e853b24547f57e6ef351852bac0418f13a0666173448f1',
         'permissions': 'all'
     }
-    objective_owkin = invokeChainCode(fcn, [json.dumps(args)], 'owkin', [cli.get_peer('peer1-owkin')])
+    objective_owkin = owkin.run(owkin.invoke(fcn, args))
 
     '''
               | |                             | |
@@ -236,7 +187,7 @@ def setup():
         'testDataset': f'{datamanager_chunantes_key}:61b113ac7142bdd1cc8a824cd29940ce0e22e2381b25e0efe34f64cad5a5ff9b',
         'permissions': 'all'
     }
-    objective_chunantes = invokeChainCode(fcn, [json.dumps(args)], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    objective_chunantes = chunantes.run(chunantes.invoke(fcn, args))
     if 'key' in objective_chunantes:
         objective_chunantes_key = objective_chunantes['key']
     # debugging purposes
@@ -253,7 +204,7 @@ def setup():
         'descriptionStorageAddress': 'http://chunantes.substra-backend:8001/algo/9ca7ffbdbb55156b0fb44a227c3c305b7f7300113b6008c662460cf0f8f7cc3a/description/',
         'permissions': 'all'
     }
-    algo_chunantes_1 = invokeChainCode(fcn, [json.dumps(args)], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    algo_chunantes_1 = chunantes.run(chunantes.invoke(fcn, args))
     if 'key' in algo_chunantes_1:
         algo_chunantes_1_key = algo_chunantes_1['key']
     # debugging purposes
@@ -261,10 +212,10 @@ def setup():
         algo_chunantes_1_key = '9ca7ffbdbb55156b0fb44a227c3c305b7f7300113b6008c662460cf0f8f7cc3a'
 
     # query data of the dataset in chu nantes
-    res = queryChaincode('queryDataManagers', [], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    res = chunantes.run(chunantes.query('queryDataManagers', []))
     print(res)
 
-    res = queryChaincode('queryTraintuples', [], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    res = chunantes.run(chunantes.query('queryTraintuples', []))
     print(res)
 
     # create parent traintuple
@@ -279,7 +230,7 @@ def setup():
         'rank': '',
         'tag': 'foo'
     }
-    traintuple = invokeChainCode(fcn, [json.dumps(args)], 'chu-nantes', [cli.get_peer('peer1-chu-nantes')])
+    traintuple = chunantes.run(chunantes.invoke(fcn, args))
 
     if isinstance(traintuple, dict) and 'key' in traintuple:
         traintuple_key = traintuple['key']
@@ -291,14 +242,10 @@ def setup():
 
 
 if __name__ == "__main__":
-    files = glob.glob(f'{SUBSTRA_PATH}/conf/config/conf-*.json')
-    files.sort(key=os.path.getmtime)
-    orgs = [json.load(open(file_path, 'r')) for file_path in files]
-
-    cli = init_cli(orgs)
-
-    # add channel on cli
-    channel_name = orgs[0]['misc']['channel_name']
-    cli.new_channel(channel_name)
+    cli = init_cli()
+    owkin = ChaincodeClient(cli, 'owkin', verbose=True)
+    chunantes = ChaincodeClient(cli, 'chu-nantes', verbose=True)
 
     setup()
+    retry_stats.print()
+    owkin.close()
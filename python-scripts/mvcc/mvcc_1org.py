@@ -12,127 +12,96 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
-import glob
+# MVCC contention benchmark: concurrent clients invoking the chaincode on a few hot keys, e.g.
+#   python3 mvcc/mvcc_1org.py --clients 20 --invokes 100 --hot-keys 1
+# registers the same data manager 100 times from 20 clients, or
+#   python3 mvcc/mvcc_1org.py --fcn logStartTrain --args '{"key": "{key}"}' --keys <traintuple key> --duration 60
+# and reports the outcome of every invoke, the conflict rate, throughput and latency percentiles as json,
+# to compare runs across chaincode versions
+
+import argparse
 import json
-import os
-from multiprocessing import Pool
-
-from subprocess import call
-
-from utils.cli import init_cli
-
-SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
-
-
-def queryChaincode(fcn, args, org_name, peers):
-    print(f"Query chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_query(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-    ))
-
-    return response
-
-
-def invokeChainCode(fcn, args, org_name, peers):
-    print(f"Invoke chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'admin')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_invoke(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-        wait_for_event=True
-    ))
-
-    print(response)
-
-    try:
-        res = json.loads(response)
-    except:
-        res = response
-    finally:
-        print('res: ', res, flush=True)
-        return res
-
-
-def createInParallel(fcn, args, org_name, peers):
-    invokeChainCode(fcn, args, org_name, peers)
-
-
-def setup():
-    res = queryChaincode('queryObjectives', None, 'owkin', [cli.get_peer('peer1-owkin')])
-    print(res)
-
-    print('register DataManager', flush=True)
-    fcn = 'registerDataManager'
-    with Pool(processes=20) as pool:
-        pool.starmap(createInParallel, [
-            (fcn,
-             [json.dumps({
-                 'name': 'ISIC 2018',
-                 'openerHash': 'ccbaa3372bc74bce39ce3b138f558b3a7558958ef2f244576e18ed75b0cea994',
-                 'openerStorageAddress': 'http://owkin.substra-backend:8001/dataset/ccbaa3372bc74bce39ce3b138f558b3a7558958ef2f244576e18ed75b0cea994/opener/',
-                 'type': 'Images',
-                 'descriptionHash': '7a90514f88c70002608a9868681dd1589ea598e78d00a8cd7783c3ea0f9ceb09',
-                 'descriptionStorageAddress': 'http://owkin.substra-backend:8001/dataset/ccbaa3372bc74bce39ce3b138f558b3a7558958ef2f244576e18ed75b0cea994/description/',
-                 'objectiveKey': '',
-                 'permissions': 'all'
-             })],
-             'owkin',
-             ['peer1-owkin']
-             ) for i in range(0, 100)])
-
-
-def run():
-    res = True
-
-    # Invoke chaincode with 1st peers of each org
-    setup()
-
-    # Query chaincode from the 1st peer of the 1st org after Invoke
-    res = res and queryChaincode('queryObjectives', [], 'owkin', [cli.get_peer('peer1-owkin')])
-    print(res)
-
-    # Query chaincode on 2nd peer of 2nd org
-    res = res and queryChaincode('queryObjectives', [], 'owkin', [cli.get_peer('peer2-owkin')])
-    print(res)
-
-    if res:
-        print('Congratulations! The fixtures have been loaded successfully.', flush=True)
-        call(['touch', f'{SUBSTRA_PATH}/data/log/fixtures.successful'])
-    else:
-        print('Loading fixtures failed.', flush=True)
-        call(['touch', f'{SUBSTRA_PATH}/data/log/fixtures.fail'])
+import uuid
+from hashlib import sha256
+
+from utils.benchmark_utils import benchmark_contention, contention_report, format_args
+from utils.cli import PEER_SELECTION, PEER_SELECTIONS, init_cli, print_peer_stats
+from utils.config_utils import load_confs
+
+# same data manager for every invoke on a hot key
+REGISTER_DATAMANAGER = {
+    'name': 'ISIC 2018',
+    'openerHash': '{key}',
+    'openerStorageAddress': 'http://owkin.substra-backend:8001/dataset/{key}/opener/',
+    'type': 'Images',
+    'descriptionHash': '7a90514f88c70002608a9868681dd1589ea598e78d00a8cd7783c3ea0f9ceb09',
+    'descriptionStorageAddress': 'http://owkin.substra-backend:8001/dataset/{key}/description/',
+    'objectiveKey': '',
+    'permissions': {
+        'process': {
+            'public': True,
+            'authorizedIDs': []
+        }
+    }
+}
 
 
 if __name__ == "__main__":
-    files = glob.glob(f'{SUBSTRA_PATH}/conf/config/conf-*.json')
-    files.sort(key=os.path.getmtime)
-    orgs = [json.load(open(file_path, 'r')) for file_path in files]
-
-    cli = init_cli(orgs)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--org', type=str, default='owkin', help='org of the admin invoking the chaincode')
+    parser.add_argument('--peers', nargs='+', type=str, default=None,
+                        help='endorsing peers, default: chosen among the peers of the org')
+    parser.add_argument('--selection', choices=PEER_SELECTIONS, default=PEER_SELECTION,
+                        help='how endorsing peers are chosen when they are not given')
+    parser.add_argument('--clients', type=int, default=20, help='concurrent clients')
+    parser.add_argument('--invokes', type=int, default=100, help='total invokes')
+    parser.add_argument('--duration', type=float, default=None, help='invoke for this many seconds instead')
+    parser.add_argument('--fcn', type=str, default='registerDataManager')
+    parser.add_argument('--args', type=json.loads, default=None,
+                        help="json arguments, '{key}' being replaced by a hot key, '{i}' by the invoke index, "
+                             "default: a data manager with the hot key as opener hash")
+    parser.add_argument('--keys', nargs='+', type=str, default=None, help='hot keys')
+    parser.add_argument('--hot-keys', type=int, default=1, help='number of hot keys to generate if none is given')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the commit of an invoke')
+    parser.add_argument('--rate', type=float, default=None, help='maximum invokes per second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', type=str, default=None, help='also write the json report to this file')
+    args = vars(parser.parse_args())
+
+    if args['clients'] < 1 or args['hot_keys'] < 1:
+        parser.error('the benchmark needs at least one client and one hot key')
+    if args['args'] is None and args['fcn'] != 'registerDataManager':
+        parser.error(f"--args is needed to invoke {args['fcn']}")
+
+    if args['keys'] is None:
+        # new keys on every run, so that assets registered by a previous run do not get in the way
+        run_id = uuid.uuid4().hex
+        args['keys'] = [sha256(f'{run_id}-{k}'.encode()).hexdigest() for k in range(args['hot_keys'])]
+    if args['args'] is None:
+        args['args'] = REGISTER_DATAMANAGER
+    try:
+        format_args(args['args'], key=args['keys'][0], i=0, client=0)
+    except ValueError as e:
+        parser.error(f'cannot format --args: {e}')
 
-    # add channel on cli
-    channel_name = orgs[0]['misc']['channel_name']
+    cli = init_cli()
+    misc = load_confs('orderer')[0]['misc']
+    channel_name, chaincode_name = misc['channel_name'], misc['chaincode_name']
     cli.new_channel(channel_name)
 
-    run()
+    print(f"{args['clients']} clients invoking {args['fcn']} on {len(args['keys'])} hot keys", flush=True)
+    samples, elapsed = benchmark_contention(
+        cli, args['org'], args['peers'], args['fcn'], args['args'], args['keys'],
+        clients=args['clients'], invokes=args['invokes'], duration=args['duration'], channel_name=channel_name,
+        chaincode_name=chaincode_name, timeout=args['timeout'], rate=args['rate'], seed=args['seed'],
+        selection=args['selection'])
+
+    config = {name: args[name] for name in ('org', 'peers', 'clients', 'invokes', 'duration', 'fcn', 'keys',
+                                            'timeout', 'rate', 'seed', 'selection')}
+    report = contention_report(samples, elapsed, config)
+    print(json.dumps(report, indent=4), flush=True)
+    print_peer_stats()
+
+    if args['report']:
+        with open(args['report'], 'w') as f:
+            json.dump(report, f, indent=4)
@@ -12,45 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
-import glob
-import json
 import os
 
 from utils.cli import init_cli
+from utils.invoke_utils import ChaincodeClient, is_committed
 from subprocess import check_call
 
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
 
 
-def queryChaincode(fcn, args, org_name, peers):
-    print(f"Query chaincode on org {org_name}", flush=True)
-
-    requestor = cli.get_user(org_name, 'user')
-    channel_name = 'substrachannel'
-    chaincode_name = 'substracc'
-
-    loop = asyncio.get_event_loop()
-    response = loop.run_until_complete(cli.chaincode_query(
-        requestor=requestor,
-        channel_name=channel_name,
-        peers=peers,
-        fcn=fcn,
-        args=args,
-        cc_name=chaincode_name,
-    ))
-
-    return response
-
-
 def run():
 
-    res = queryChaincode('queryObjectives', None, 'owkin', [cli.get_peer('peer1-owkin')])
-
-    print(res)
+    # the query succeeds when the chaincode answers with json, even an empty result ('null'),
+    # not when it fails or its endorsement is rejected with a plain text message
+    try:
+        res = client.run(client.query('queryObjectives', decode=False))
+    except Exception as e:
+        print(e, flush=True)
+        success = False
+    else:
+        print(res)
+        success = is_committed(res)
 
-    if res:
+    if success:
         print('Query Success')
         check_call(['touch', f'{SUBSTRA_PATH}/data/log/query.successful'])
     else:
@@ -59,14 +44,7 @@ def run():
 
 
 if __name__ == "__main__":
-    files = glob.glob(f'{SUBSTRA_PATH}/conf/config/conf-*.json')
-    files.sort(key=os.path.getmtime)
-    orgs = [json.load(open(file_path, 'r')) for file_path in files]
-
-    cli = init_cli(orgs)
-
-    # add channel on cli
-    channel_name = orgs[0]['misc']['channel_name']
-    cli.new_channel(channel_name)
+    cli = init_cli()
+    client = ChaincodeClient(cli, 'owkin', user_name='user', verbose=True)
 
     run()
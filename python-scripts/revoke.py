@@ -12,19 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
-import glob
 import os
 import asyncio
-import copy
 import time
 
+from base64 import b64decode
 from subprocess import call
 
 
 from utils.cli import init_cli
+from utils.config_utils import load_conf, load_confs
+from utils.configtx_utils import compute_update_envelope
 from hfc.fabric_ca.caservice import ca_service
-from hfc.fabric.block_decoder import decode_config
+from hfc.protos.common import configtx_pb2
+from hfc.protos.msp import msp_config_pb2
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
 
@@ -62,67 +63,24 @@ def fetchConfigBlock():
 
 def createConfigUpdatePayloadWithCRL(old_config, crl):
 
-    new_config = copy.deepcopy(old_config)
-    new_config['channel_group']['groups']['Application']['groups'][org['name']]['values']['MSP']['value']['config'][
-        'revocation_list'] = [crl]
-
-    json.dump(old_config, open('/tmp/old_config.json', 'w'))
-    call(['configtxlator',
-          'proto_encode',
-          '--type', 'common.Config',
-          '--input', '/tmp/old_config.json',
-          '--output', '/tmp/old_config.block'
-          ])
-
-    json.dump(new_config, open('/tmp/new_config.json', 'w'))
-    call(['configtxlator',
-          'proto_encode',
-          '--type', 'common.Config',
-          '--input', '/tmp/new_config.json',
-          '--output', '/tmp/new_config.block'
-          ])
-
-    # Compute update
-    call(['configtxlator',
-          'compute_update',
-          '--channel_id', org['misc']['channel_name'],
-          '--original', '/tmp/old_config.block',
-          '--updated', '/tmp/new_config.block',
-          '--output', '/tmp/compute_update.pb'
-          ])
-
-    call(['configtxlator',
-          'proto_decode',
-          '--type', 'common.ConfigUpdate',
-          '--input', '/tmp/compute_update.pb',
-          '--output', '/tmp/config_update.json'
-          ])
-
-    config_update = json.load(open('/tmp/config_update.json'))
-
-    config_update_as_envelope = {
-        'payload': {
-            'header': {
-                'channel_header': {
-                    'channel_id': org['misc']['channel_name'],
-                    'type': 2,
-                }
-            },
-            'data': {
-                'config_update': config_update
-            }
-        }
-    }
-
-    json.dump(config_update_as_envelope, open('/tmp/proposal.json', 'w'))
+    new_config = configtx_pb2.Config()
+    new_config.CopyFrom(old_config)
 
-    config_tx_file = '/tmp/proposal.pb'
+    msp_value = new_config.channel_group.groups['Application'].groups[org['name']].values['MSP']
+    msp_config = msp_config_pb2.MSPConfig()
+    msp_config.ParseFromString(msp_value.value)
+    fabric_msp_config = msp_config_pb2.FabricMSPConfig()
+    fabric_msp_config.ParseFromString(msp_config.config)
+
+    del fabric_msp_config.revocation_list[:]
+    fabric_msp_config.revocation_list.append(b64decode(crl))
 
-    call(['configtxlator',
-          'proto_encode',
-          '--input', '/tmp/proposal.json',
-          '--type', 'common.Envelope',
-          '--output', config_tx_file])
+    msp_config.config = fabric_msp_config.SerializeToString()
+    msp_value.value = msp_config.SerializeToString()
+
+    config_tx_file = '/tmp/proposal.pb'
+    with open(config_tx_file, 'wb') as f:
+        f.write(compute_update_envelope(org['misc']['channel_name'], old_config, new_config))
 
     return config_tx_file
 
@@ -163,9 +121,7 @@ def revokeFirstOrgUser():
 
     config_envelope = fetchConfigBlock()
 
-    old_config = decode_config(config_envelope.config)
-
-    config_tx_file = createConfigUpdatePayloadWithCRL(old_config, crl)
+    config_tx_file = createConfigUpdatePayloadWithCRL(config_envelope.config, crl)
 
     updateConfigBlock(config_tx_file)
 
@@ -181,14 +137,11 @@ def revokeFirstOrgUser():
 
 
 if __name__ == "__main__":
-    files = glob.glob(f'{SUBSTRA_PATH}/conf/config/conf-*.json')
-    files.sort(key=os.path.getmtime)
-    orgs = [json.load(open(file_path, 'r')) for file_path in files]
-    cli = init_cli(orgs)
+    cli = init_cli()
 
     org_name = 'owkin'
-    org = [x for x in orgs if x['name'] == org_name][0]
-    orderer = [x for x in orgs if x['type'] == 'orderer'][0]
+    org = load_conf(org_name)
+    orderer = load_confs('orderer')[0]
 
     cli.new_channel(org['misc']['channel_name'])
 
@@ -20,7 +20,29 @@ from subprocess import call
 
 from utils.cli import init_cli, update_cli
 from utils.run_utils import Client, ChannelAlreadyExist
-from utils.common_utils import remove_chaincode_docker_containers
+from utils.common_utils import remove_chaincode_docker_containers, tls_context, wait_endpoints
+
+
+# Wait for orderers and peers to accept tls connections, all at once
+def waitForNodes(confs, timeout=90):
+    env = os.environ.get('ENV', 'external')
+    nodes = [(o, o['port']['internal']) for conf in confs for o in conf.get('orderers', [])] + \
+            [(p, p['port'][env]) for conf in confs for p in conf.get('peers', [])]
+
+    endpoints = []
+    for node, port in nodes:
+        tls_client_dir = os.path.join(node['tls']['dir']['external'], node['tls']['client']['dir'])
+        endpoints.append({
+            'what': node['name'],
+            'host': node['host'],
+            'port': port,
+            'check': 'tls',
+            'ssl': tls_context(os.path.join(tls_client_dir, node['tls']['client']['ca']),
+                               os.path.join(tls_client_dir, node['tls']['client']['cert']),
+                               os.path.join(tls_client_dir, node['tls']['client']['key']))
+        })
+
+    return all(result['ready'] for result in wait_endpoints(endpoints, timeout))
 
 
 # We need to retry as we cannot know when the channel is created and its genesis block is available
@@ -87,11 +109,9 @@ def add_org():
         chaincode_version = client.getChaincodeVersion(conf_externals[0])
         new_chaincode_version = '%.1f' % (chaincode_version + 1.0)
 
-        # Install chaincode on peer in each org
-        orgs_mspid = []
-        for conf_org in [conf] + conf_externals:
-            client.installChainCodeOnPeers(conf_org, new_chaincode_version)
-            orgs_mspid.append(conf_org['mspid'])
+        # Install chaincode on peers of each org
+        client.installChainCodeOnOrgs([conf] + conf_externals, new_chaincode_version)
+        orgs_mspid = [conf_org['mspid'] for conf_org in [conf] + conf_externals]
 
         # upgrade chaincode with new policy
         client.upgradeChainCode(conf_externals[0], orgs_mspid, new_chaincode_version, 'init')
@@ -132,4 +152,7 @@ if __name__ == "__main__":
 
     cli = init_cli([conf, conf_orderer])
     client = Client(cli, conf, conf_orderer)
+    if not waitForNodes([conf, conf_orderer]):
+        call(['touch', conf['misc']['run_fail_file']])
+        exit(1)
     add_org()
@@ -14,9 +14,11 @@
 
 import json
 import os
+import time
 from subprocess import call
 
-from utils.setup_utils import registerIdentities, registerUsers, generateGenesis, enrollWithFiles, genTLSCert, writeFile
+from utils.setup_utils import (registerIdentities, registerUsers, generateGenesis, enrollWithFiles, genTLSCert,
+                               writeFile, runBatch, pregenerateKeys)
 from utils.common_utils import create_directory
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
@@ -35,58 +37,77 @@ def generateMSPandTLS(node, org, msp_dir, admincerts=False):
     tls_server_dir = os.path.join(tls_setup_dir, node['tls']['server']['dir'])
     tls_client_dir = os.path.join(tls_setup_dir, node['tls']['client']['dir'])
 
-    # Generate server TLS cert and key pair in container
-    genTLSCert(node, org,
-               cert_file=os.path.join(tls_server_dir, node['tls']['server']['cert']),
-               key_file=os.path.join(tls_server_dir, node['tls']['server']['key']),
-               ca_file=os.path.join(tls_server_dir, node['tls']['server']['ca']))
+    # Server TLS, client TLS (for the peer CLI, will be used by external tools, in a binded volume)
+    # and enrollment certificate for the core's local MSP directory, all requested at once
+    runBatch([
+        lambda: genTLSCert(node, org,
+                           cert_file=os.path.join(tls_server_dir, node['tls']['server']['cert']),
+                           key_file=os.path.join(tls_server_dir, node['tls']['server']['key']),
+                           ca_file=os.path.join(tls_server_dir, node['tls']['server']['ca'])),
+        lambda: genTLSCert(node, org,
+                           cert_file=os.path.join(tls_client_dir, node['tls']['client']['cert']),
+                           key_file=os.path.join(tls_client_dir, node['tls']['client']['key']),
+                           ca_file=os.path.join(tls_client_dir, node['tls']['client']['ca'])),
+        lambda: enrollWithFiles(node, org, msp_dir, admincerts=admincerts),
+    ])
 
-    # Generate client TLS cert and key pair for the peer CLI (will be used by external tools)
-    # in a binded volume
-    genTLSCert(node, org,
-               cert_file=os.path.join(tls_client_dir, node['tls']['client']['cert']),
-               key_file=os.path.join(tls_client_dir, node['tls']['client']['key']),
-               ca_file=os.path.join(tls_client_dir, node['tls']['client']['ca']))
 
-    # Enroll the node to get an enrollment certificate and set up the core's local MSP directory for starting node
-    enrollWithFiles(node, org, msp_dir, admincerts=admincerts)
+def init_peer(peer, conf, enrollmentAdmin):
+    start = time.time()
 
+    setup_peer_msp_dir = os.path.join(conf['core_dir']['internal'], peer['name'], 'msp')
+    generateMSPandTLS(peer, conf, setup_peer_msp_dir, admincerts=False)
 
-def init_org(conf, enrollmentAdmin):
+    # copy the admincerts from the admin user for being able to install chaincode
+    # https://stackoverflow.com/questions/48221810/what-is-difference-between-admincerts-and-signcerts-in-hyperledge-fabric-msp
+    # https://lists.hyperledger.org/g/fabric/topic/17549225#1250
+    # https://github.com/hyperledger/fabric-sdk-go/blob/master/internal/github.com/hyperledger/fabric/msp/mspimpl.go#L460
+    # https://jira.hyperledger.org/browse/FAB-3840
+    admin = conf['users']['admin']
+    filename = os.path.join(setup_peer_msp_dir, 'admincerts', '%s-cert.pem' % admin['name'])
+    writeFile(filename, enrollmentAdmin._cert)
+
+    return peer['name'], time.time() - start
+
+
+def init_orderer_node(orderer, conf):
+    start = time.time()
 
-    for peer in conf['peers']:
-        setup_peer_msp_dir = os.path.join(conf['core_dir']['internal'], peer['name'], 'msp')
-        generateMSPandTLS(peer, conf, setup_peer_msp_dir, admincerts=False)
+    setup_orderer_msp_dir = os.path.join(conf['core_dir']['internal'], orderer['name'], 'msp')
+    # copy the admincerts from the user for being able to launch orderer
+    generateMSPandTLS(orderer, conf, setup_orderer_msp_dir, admincerts=True)
 
-        # copy the admincerts from the admin user for being able to install chaincode
-        # https://stackoverflow.com/questions/48221810/what-is-difference-between-admincerts-and-signcerts-in-hyperledge-fabric-msp
-        # https://lists.hyperledger.org/g/fabric/topic/17549225#1250
-        # https://github.com/hyperledger/fabric-sdk-go/blob/master/internal/github.com/hyperledger/fabric/msp/mspimpl.go#L460
-        # https://jira.hyperledger.org/browse/FAB-3840
-        admin = conf['users']['admin']
-        filename = os.path.join(setup_peer_msp_dir, 'admincerts', '%s-cert.pem' % admin['name'])
-        writeFile(filename, enrollmentAdmin._cert)
+    return orderer['name'], time.time() - start
+
+
+# all nodes at once, returns [(node name, duration)]
+def init_org(conf, enrollmentAdmin):
+    return runBatch([lambda peer=peer: init_peer(peer, conf, enrollmentAdmin) for peer in conf['peers']])
 
 
 def init_orderer(conf):
-    for orderer in conf['orderers']:
-        setup_orderer_msp_dir = os.path.join(conf['core_dir']['internal'], orderer['name'], 'msp')
-        # copy the admincerts from the user for being able to launch orderer
-        generateMSPandTLS(orderer, conf, setup_orderer_msp_dir, admincerts=True)
+    return runBatch([lambda orderer=orderer: init_orderer_node(orderer, conf) for orderer in conf['orderers']])
 
 
 def init(conf, enrollmentAdmin):
+    timings = []
     if 'peers' in conf:
-        init_org(conf, enrollmentAdmin)
+        timings += init_org(conf, enrollmentAdmin)
     if 'orderers' in conf:
-        init_orderer(conf)
+        timings += init_orderer(conf)
         create_directory(conf['broadcast_dir']['external'])
         generateGenesis(conf)
 
+    print('MSP and TLS generation per node:', flush=True)
+    for name, duration in timings:
+        print(f'  {name}: {duration:.2f}s', flush=True)
+
 
 if __name__ == '__main__':
 
     conf = json.load(open(f'{SUBSTRA_PATH}/conf.json', 'r'))
+    # server and client tls keys of every node
+    pregenerateKeys(conf, 2 * (len(conf.get('peers', [])) + len(conf.get('orderers', []))))
     registerIdentities(conf)
     enrollmentAdmin = registerUsers(conf)
     init(conf, enrollmentAdmin)
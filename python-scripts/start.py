@@ -14,19 +14,20 @@
 
 import os
 import glob
-import json
 import argparse
 
 from yaml import load, FullLoader
 
-from subprocess import call, check_call
+from subprocess import DEVNULL, call, check_call
 
 from utils.common_utils import (dowait, create_directory, remove_chaincode_docker_images,
-                                remove_chaincode_docker_containers)
+                                remove_chaincode_docker_containers, remove_fail_markers)
 from utils.config_utils import (create_configtx, create_ca_server_config, create_ca_client_config, create_peer_config,
-                                create_orderer_config, create_substra_backend_config)
+                                create_orderer_config, create_substra_backend_config, load_confs, write_conf_index,
+                                written_files)
 from utils.docker_utils import (generate_docker_compose_org, generate_docker_compose_orderer, generate_fixtures_docker,
                                 generate_revoke_docker, generate_query_docker)
+from utils.dag_utils import run_dag
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -64,25 +65,43 @@ def remove_all_docker():
 
 def intern_stop(docker_compose):
     print('stopping container', flush=True)
-    os.environ['COMPOSE_IGNORE_ORPHANS'] = 'True'
     check_call(['docker-compose', '-f', docker_compose, '--project-directory', dir_path, 'down'])
-    os.environ['COMPOSE_IGNORE_ORPHANS'] = 'False'
 
 
-def start(conf, docker_compose):
-    os.environ['COMPOSE_IGNORE_ORPHANS'] = 'True'
+# Services mounting a config file which has been rewritten by this run
+def changed_services(services):
+    return [name for name, dconfig in services
+            if any(os.path.normpath(volume.split(':')[0]) in written_files for volume in dconfig.get('volumes', []))]
+
+
+# docker-compose only recreates a running service when its definition changed,
+# force it for the ones whose mounted config files changed
+def compose_up(docker_compose, services, *args):
     project_directory = os.path.join(dir_path, os.pardir)
-    print('Start docker-compose', flush=True)
+    recreate = changed_services(services)
+    names = [name for name, _ in services]
 
+    if [name for name in names if name not in recreate]:
+        check_call(['docker-compose', '-f', docker_compose['path'], '--project-directory', project_directory, 'up',
+                    '-d'] + list(args) + [name for name in names if name not in recreate])
+    if recreate:
+        print(f'Configuration changed, recreate {recreate}', flush=True)
+        check_call(['docker-compose', '-f', docker_compose['path'], '--project-directory', project_directory, 'up',
+                    '-d', '--force-recreate'] + list(args) + recreate)
+
+
+def start_rca(conf, docker_compose):
     # RCA
-    print('Start Root Certificate Authority', flush=True)
-    services = [name for name, _ in docker_compose['substra_services']['rca']]
-    check_call(['docker-compose', '-f', docker_compose['path'], '--project-directory', project_directory, 'up', '-d'] +
-               services)
+    print(f"Start Root Certificate Authority of {conf['name']}", flush=True)
+    compose_up(docker_compose, docker_compose['substra_services']['rca'])
 
     check_call(['docker', 'ps', '-a', '--format', 'table {{.ID}}\t{{.Names}}\t{{.Status}}\t{{.Ports}}',
                 '--filter', 'label=substra'])
 
+
+def start_setup(conf, docker_compose):
+    project_directory = os.path.join(dir_path, os.pardir)
+
     # Setup
     print(conf['misc']['setup_success_file'])
     if not os.path.exists(conf['misc']['setup_success_file']):
@@ -100,12 +119,16 @@ def start(conf, docker_compose):
             exit(1)
     else:
         print('Setup not launched because %s exists.' % conf['misc']['setup_success_file'])
+        configtx = os.path.normpath(os.path.join(conf['misc']['configtx-config-path'], 'configtx.yaml'))
+        if configtx in written_files:
+            print(f'Warning: {configtx} changed but is only used by setup, use --no-backup to apply it', flush=True)
 
+
+def start_services(conf, docker_compose):
     # SVC
     services = [name for name, _ in docker_compose['substra_services']['svc']]
     print('Start services %s' % services, flush=True)
-    check_call(['docker-compose', '-f', docker_compose['path'], '--project-directory', project_directory, 'up', '-d',
-               '--no-deps'] + services)
+    compose_up(docker_compose, docker_compose['substra_services']['svc'], '--no-deps')
 
     if 'orgs' in conf:
         peers_orgs_files = [peer['tls']['clientCert']
@@ -118,6 +141,10 @@ def start(conf, docker_compose):
         if not success:
             exit(1)
 
+
+def start_run(conf, docker_compose):
+    project_directory = os.path.join(dir_path, os.pardir)
+
     # Run
     with open(docker_compose['path']) as dockercomposefile:
         dockercomposeconf = load(dockercomposefile, Loader=FullLoader)
@@ -125,6 +152,7 @@ def start(conf, docker_compose):
 
     if has_run and 'run_success_file' in conf['misc']:
         if not os.path.exists(conf['misc']['run_success_file']):
+            remove_fail_markers([conf['misc']['run_success_file']])
             check_call(['docker-compose', '-f', docker_compose['path'], '--project-directory', project_directory, 'up', '-d',
                        '--no-deps', 'run'])
 
@@ -137,10 +165,8 @@ def start(conf, docker_compose):
         else:
             print(f"Run not launched because {conf['misc']['run_success_file']} exists.")
 
-    os.environ['COMPOSE_IGNORE_ORPHANS'] = 'False'
 
-
-def substra_org(org, orderer=None):
+def substra_org(org, orderer=None, incremental=False):
     org_name = org['name']
 
     print(f'Prepare Node : {org_name}')
@@ -161,8 +187,8 @@ def substra_org(org, orderer=None):
         # create_fabric_ca_peer_config(org)
         # Docker-compose for org
         docker_compose = generate_docker_compose_org(org, orderer, SUBSTRA_PATH, SUBSTRA_NETWORK)
-        intern_stop(docker_compose['path'])
-        start(org, docker_compose)
+        if not incremental:
+            intern_stop(docker_compose['path'])
 
     # Orderer Config files
     if org['type'] == 'orderer':
@@ -171,33 +197,78 @@ def substra_org(org, orderer=None):
         docker_compose = generate_docker_compose_orderer(org,
                                                          SUBSTRA_PATH,
                                                          SUBSTRA_NETWORK)
-        intern_stop(docker_compose['path'])
-        start(org, docker_compose)
+        if not incremental:
+            intern_stop(docker_compose['path'])
 
+    return docker_compose
 
-def substra_network(org):
 
-    # Stop all
-    docker_compose_paths = glob.glob(os.path.join(SUBSTRA_PATH, 'dockerfiles/*.yaml'))
+def substra_backend(org, orderer):
+    # substra-backend
+    create_directory(f"{SUBSTRA_PATH}/dryrun/{org['name']}")
+    create_substra_backend_config(org, orderer)
 
-    # Remove all
-    remove_all_docker()
 
-    for docker_compose_path in docker_compose_paths:
-        intern_stop(docker_compose_path)
+# Bring up graph, orgs are independent until they touch the channels:
+#   config -> rca -> setup -> services, for every org
+#   run of a client org needs the orderer services and, as it updates the system and application channels,
+#   the run of the previous client org
+def bring_up_tasks(orgs, incremental=False):
+    tasks = {}
+    docker_composes = {}
+
+    orderer = [x for x in orgs if x['type'] == 'orderer'][0]
+    clients = [x for x in orgs if x['type'] == 'client']
+
+    def config(org):
+        docker_composes[org['name']] = substra_org(org, orderer if org['type'] == 'client' else None, incremental)
+
+    def phase(func, org):
+        return lambda: func(org, docker_composes[org['name']])
+
+    for org in [orderer] + clients:
+        name = org['name']
+        tasks[f'{name}.config'] = (lambda org=org: config(org), [])
+        tasks[f'{name}.rca'] = (phase(start_rca, org), [f'{name}.config'])
+        tasks[f'{name}.setup'] = (phase(start_setup, org), [f'{name}.rca'])
+        tasks[f'{name}.services'] = (phase(start_services, org), [f'{name}.setup'])
+
+    previous_run = None
+    for org in clients:
+        name = org['name']
+        deps = [f'{name}.services', f"{orderer['name']}.services"] + ([previous_run] if previous_run else [])
+        tasks[f'{name}.run'] = (phase(start_run, org), deps)
+        tasks[f'{name}.backend'] = (lambda org=org: substra_backend(org, orderer), [f'{name}.run'])
+        previous_run = f'{name}.run'
+
+    return tasks
+
+
+# incremental keeps running containers, only the ones whose configuration changed are recreated
+def substra_network(orgs, incremental=False):
+
+    os.environ['COMPOSE_IGNORE_ORPHANS'] = 'True'
+
+    if not incremental:
+        # Stop all
+        docker_compose_paths = glob.glob(os.path.join(SUBSTRA_PATH, 'dockerfiles/*.yaml'))
+
+        # Remove all
+        remove_all_docker()
+
+        for docker_compose_path in docker_compose_paths:
+            intern_stop(docker_compose_path)
 
     # Create Network
-    check_call(['docker', 'network', 'create', SUBSTRA_NETWORK])
+    if call(['docker', 'network', 'inspect', SUBSTRA_NETWORK], stdout=DEVNULL) != 0:
+        check_call(['docker', 'network', 'create', SUBSTRA_NETWORK])
 
-    for orderer in [x for x in orgs if x['type'] == 'orderer']:
-        substra_org(orderer)
-    else:
-        # Prepare each org
-        for org in [x for x in orgs if x['type'] == 'client']:
-            substra_org(org, orderer)
-            # substra-backend
-            create_directory(f"{SUBSTRA_PATH}/dryrun/{org['name']}")
-            create_substra_backend_config(org, orderer)
+    results = run_dag(bring_up_tasks(orgs, incremental))
+
+    os.environ['COMPOSE_IGNORE_ORPHANS'] = 'False'
+
+    if any(result['status'] != 'done' for result in results.values()):
+        exit(1)
 
 
 if __name__ == '__main__':
@@ -213,10 +284,16 @@ if __name__ == '__main__':
                         help="Revoke user and test querying")
     parser.add_argument('-q', '--query', action='store_true', default=False,
                         help="Query with user")
+    parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                        help="Keep running containers, only regenerate changed configuration files "
+                             "and restart the services using them")
     args = vars(parser.parse_args())
 
+    incremental = args['incremental'] and not args['no_backup']
+
     # Stop all docker
-    remove_all_docker()
+    if not incremental:
+        remove_all_docker()
 
     if args['no_backup']:
         # create directory with correct rights
@@ -239,16 +316,15 @@ if __name__ == '__main__':
         else:
             check_call(['python3', os.path.join(dir_path, 'conf/2orgs.py')])
 
-    files = glob.glob(f'{SUBSTRA_PATH}/conf/config/conf-*.json')
-    files.sort(key=os.path.getmtime)
-    orgs = [json.load(open(file_path, 'r')) for file_path in files]
+    # index conf files for the clients of the network, which load orgs on demand
+    orgs = load_confs(index=write_conf_index())
 
     print('  Organizations :', flush=True)
     for org in orgs:
         print('   -', org['name'], flush=True)
     print('', flush=True)
 
-    substra_network(orgs)
+    substra_network(orgs, incremental)
 
     os.environ['COMPOSE_IGNORE_ORPHANS'] = 'True'
 
@@ -257,6 +333,7 @@ if __name__ == '__main__':
         fixtures_path = f'fixtures{len(orgs) - 1}org{suffix}.py'
         docker_compose_path = generate_fixtures_docker(SUBSTRA_PATH, fixtures_path, SUBSTRA_NETWORK)
         project_directory = os.path.join(dir_path, os.pardir)
+        remove_fail_markers([f'{SUBSTRA_PATH}/data/log/fixtures.successful'])
         check_call(['docker-compose', '-f', docker_compose_path, '--project-directory', project_directory, 'up', '-d',
                    '--no-deps', 'fixtures'])
         # Wait for the run container to start and complete
@@ -272,6 +349,7 @@ if __name__ == '__main__':
     if args['query']:
         docker_compose_path = generate_query_docker(SUBSTRA_PATH, SUBSTRA_NETWORK)
         project_directory = os.path.join(dir_path, os.pardir)
+        remove_fail_markers([f'{SUBSTRA_PATH}/data/log/query.successful'])
         check_call(['docker-compose', '-f', docker_compose_path, '--project-directory', project_directory, 'up', '-d',
                    '--no-deps', 'query'])
         # Wait for the run container to start and complete
@@ -287,6 +365,7 @@ if __name__ == '__main__':
     if args['revoke']:
         docker_compose_path = generate_revoke_docker(SUBSTRA_PATH, SUBSTRA_NETWORK)
         project_directory = os.path.join(dir_path, os.pardir)
+        remove_fail_markers([f'{SUBSTRA_PATH}/data/log/revoke.successful'])
         check_call(['docker-compose', '-f', docker_compose_path, '--project-directory', project_directory, 'up', '-d',
                    '--no-deps', 'revoke'])
         # Wait for the run container to start and complete
@@ -0,0 +1,119 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from hfc.fabric.block_decoder import decode_config
+from hfc.protos.common import common_pb2, configtx_pb2
+from hfc.protos.peer import configuration_pb2 as peer_configuration_pb2
+from hfc.util.utils import extract_channel_config
+
+from utils.configtx_utils import (NoConfigUpdate, compute_update, compute_update_envelope, encode_config,
+                                  encode_config_value)
+
+
+def anchor_peers(host, port):
+    return peer_configuration_pb2.AnchorPeers(
+        anchor_peers=[peer_configuration_pb2.AnchorPeer(host=host, port=port)]).SerializeToString()
+
+
+def channel_config():
+    config = configtx_pb2.Config(sequence=3)
+    application = config.channel_group.groups['Application']
+    application.version = 1
+    application.mod_policy = 'Admins'
+    org = application.groups['owkinMSP']
+    org.values['AnchorPeers'].value = anchor_peers('peer1-owkin', 7051)
+    org.values['AnchorPeers'].mod_policy = 'Admins'
+    return config
+
+
+def decode_envelope(envelope):
+    payload = common_pb2.Payload.FromString(common_pb2.Envelope.FromString(envelope).payload)
+    channel_header = common_pb2.ChannelHeader.FromString(payload.header.channel_header)
+    config_update_envelope = configtx_pb2.ConfigUpdateEnvelope.FromString(payload.data)
+    return channel_header, configtx_pb2.ConfigUpdate.FromString(config_update_envelope.config_update)
+
+
+class TestConfigtx(unittest.TestCase):
+
+    def test_encode_decoded_config(self):
+        config = channel_config()
+        self.assertEqual(encode_config(decode_config(config)), config)
+
+    def test_compute_update_envelope(self):
+        original = decode_config(channel_config())
+        updated = decode_config(channel_config())
+        application = updated['channel_group']['groups']['Application']
+        application['groups']['owkinMSP']['values']['AnchorPeers']['value']['anchor_peers'][0]['port'] = 7052
+        application['groups']['chu-nantesMSP'] = {
+            'values': {'AnchorPeers': {'mod_policy': 'Admins', 'value': {
+                'anchor_peers': [{'host': 'peer1-chu-nantes', 'port': 7051}]}}},
+        }
+
+        channel_header, config_update = decode_envelope(
+            compute_update_envelope('substrachannel', original, updated))
+
+        self.assertEqual(channel_header.type, common_pb2.CONFIG_UPDATE)
+        self.assertEqual(channel_header.channel_id, 'substrachannel')
+        self.assertEqual(config_update.channel_id, 'substrachannel')
+
+        # a new org bumps the version of the application group, read at its current version
+        self.assertEqual(config_update.read_set.groups['Application'].version, 1)
+        write_application = config_update.write_set.groups['Application']
+        self.assertEqual(write_application.version, 2)
+        self.assertEqual(write_application.groups['chu-nantesMSP'].values['AnchorPeers'].value,
+                         anchor_peers('peer1-chu-nantes', 7051))
+
+        # a modified value bumps its own version only
+        owkin = write_application.groups['owkinMSP']
+        self.assertEqual(owkin.version, 0)
+        self.assertEqual(owkin.values['AnchorPeers'].version, 1)
+        self.assertEqual(owkin.values['AnchorPeers'].value, anchor_peers('peer1-owkin', 7052))
+
+    def test_extract_signed_config(self):
+        # what signAndPushUpdateProposal signs, and channel_update extracts again from the envelope file
+        original = decode_config(channel_config())
+        updated = decode_config(channel_config())
+        updated['channel_group']['groups']['Application']['groups']['owkinMSP']['values']['AnchorPeers']['value'][
+            'anchor_peers'][0]['port'] = 7052
+
+        config = extract_channel_config(compute_update_envelope('substrachannel', original, updated))
+
+        self.assertEqual(config, compute_update('substrachannel', original, updated).SerializeToString())
+        config_update = configtx_pb2.ConfigUpdate.FromString(config)
+        self.assertEqual(config_update.channel_id, 'substrachannel')
+        self.assertEqual(
+            config_update.write_set.groups['Application'].groups['owkinMSP'].values['AnchorPeers'].version, 1)
+
+    def test_no_update(self):
+        with self.assertRaises(NoConfigUpdate):
+            compute_update_envelope('substrachannel', decode_config(channel_config()), channel_config())
+
+    def test_consensus_type_metadata(self):
+        with self.assertRaises(ValueError):
+            encode_config_value('ConsensusType', {'value': {'type': 'etcdraft', 'metadata': {'consenters': []}}})
+
+    def test_unsupported_value(self):
+        with self.assertRaises(ValueError):
+            encode_config_value('Unknown', {'value': {'key': 'value'}})
+
+    def test_unsupported_msp_type(self):
+        with self.assertRaises(ValueError):
+            encode_config_value('MSP', {'value': {'type': 1, 'config': {'name': 'idemixMSP'}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
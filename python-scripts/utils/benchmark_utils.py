@@ -0,0 +1,195 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from hfc.protos.peer.transaction_pb2 import TxValidationCode
+
+from .cli import PEER_SELECTION, get_peer_selector
+from .events_utils import close_block_listeners
+from .fixtures_utils import RateLimiter, map_strings
+from .invoke_utils import chaincode_invoke
+
+# Outcomes of an invoke:
+#   VALID: committed
+#   MVCC_READ_CONFLICT, PHANTOM_READ_CONFLICT: invalidated by the committing peers, a key read by the transaction
+#     (or a range it queried) has been written by another transaction in between
+#   ENDORSEMENT_MISMATCH: endorsed differently by the peers, the committing peers reject it with
+#     ENDORSEMENT_POLICY_FAILURE
+#   REJECTED: not endorsed, the chaincode returned an error (e.g. asset already exists)
+#   INVALID: invalidated by the committing peers for another reason
+#   TIMEOUT: not seen in a block before the timeout
+#   ERROR: anything else (orderer refusing it, raising BroadcastError, connection errors...)
+OUTCOMES = ('VALID', 'MVCC_READ_CONFLICT', 'PHANTOM_READ_CONFLICT', 'ENDORSEMENT_MISMATCH', 'REJECTED', 'INVALID',
+            'TIMEOUT', 'ERROR')
+CONFLICTS = ('MVCC_READ_CONFLICT', 'PHANTOM_READ_CONFLICT')
+# outcomes of the invokes known to have been ordered, in a block
+ORDERED = ('VALID', 'INVALID', 'ENDORSEMENT_MISMATCH') + CONFLICTS
+
+VALIDATION_CODES = set(TxValidationCode.keys())
+
+# '{key}', '{i}', '{client}' with an optional format spec ('{i:064x}'), other braces are left as they are
+PLACEHOLDER = re.compile(r'\{(?P<name>key|i|client)(?::(?P<spec>[^{}]*))?\}')
+
+
+# chaincode_invoke returns the payload when the transaction is committed, the validation code when the committing
+# peers invalidate it, the message of the first endorsement when it is not endorsed (orderer refusals raise)
+def classify(response):
+    if response in CONFLICTS:
+        return response
+    if response == 'ENDORSEMENT_POLICY_FAILURE':
+        return 'ENDORSEMENT_MISMATCH'
+    if response in VALIDATION_CODES:
+        return 'INVALID'
+
+    try:
+        payload = json.loads(response)
+    except (TypeError, ValueError):
+        return 'REJECTED' if response else 'ERROR'
+
+    return 'REJECTED' if isinstance(payload, dict) and 'error' in payload else 'VALID'
+
+
+def classify_error(error):
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return 'TIMEOUT'
+    if str(error) in VALIDATION_CODES:
+        return classify(str(error))
+    return 'ERROR'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def latencies_report(latencies):
+    return {
+        'count': len(latencies),
+        'latency_mean': sum(latencies) / len(latencies) if latencies else 0,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p90': percentile(latencies, 0.9),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': max(latencies, default=0),
+    }
+
+
+def format_args(args, **values):
+    return map_strings(args, lambda s: PLACEHOLDER.sub(
+        lambda m: format(values[m.group('name')], m.group('spec') or ''), s))
+
+
+# samples: [{'client', 'key', 'outcome', 'start', 'latency', 'error'}]
+def contention_report(samples, elapsed, config=None):
+    outcomes = {outcome: [s['latency'] for s in samples if s['outcome'] == outcome] for outcome in OUTCOMES}
+    committed = len(outcomes['VALID'])
+    conflicts = sum(len(outcomes[outcome]) for outcome in CONFLICTS)
+    # rejected, refused or timed out invokes may never have been ordered, they cannot conflict
+    ordered = sum(len(outcomes[outcome]) for outcome in ORDERED)
+
+    keys = {}
+    for s in samples:
+        counts = keys.setdefault(s['key'], {'invokes': 0, 'committed': 0, 'conflicts': 0})
+        counts['invokes'] += 1
+        counts['committed'] += s['outcome'] == 'VALID'
+        counts['conflicts'] += s['outcome'] in CONFLICTS
+
+    return {
+        'config': config or {},
+        'elapsed': elapsed,
+        'invokes': len(samples),
+        'outcomes': {outcome: len(latencies) for outcome, latencies in outcomes.items()},
+        'conflict_rate': conflicts / ordered if ordered else 0,
+        'throughput': len(samples) / elapsed if elapsed else 0,
+        'goodput': committed / elapsed if elapsed else 0,
+        'latency': latencies_report([s['latency'] for s in samples]),
+        'latency_by_outcome': {outcome: latencies_report(latencies)
+                               for outcome, latencies in outcomes.items() if latencies},
+        'keys': keys,
+        'errors': dict(Counter(s['error'] for s in samples if s.get('error'))),
+    }
+
+
+# Run clients concurrent clients on the same event loop, each one invoking fcn with args in a loop until invokes
+# have been sent or duration has elapsed
+# Every invoke targets one of the hot keys, picked at random: '{key}' is replaced by it in the strings of args,
+# '{i}' by the index of the invoke and '{client}' by the index of the client
+# Without peers, the endorsing peers of every invoke are chosen among the peers of org with the selection strategy
+async def run_contention(cli, org, peers, fcn, args, keys, clients=20, invokes=100, duration=None,
+                         channel_name='substrachannel', chaincode_name='substracc', timeout=30, rate=None, seed=0,
+                         selection=PEER_SELECTION):
+    rng = random.Random(seed)
+    requestor = cli.get_user(org, 'admin')
+    peers = [cli.get_peer(peer) for peer in peers] if peers else None
+    selector = get_peer_selector(cli, [org], selection)
+    rate_limiter = RateLimiter(rate) if rate else None
+    # a bad format spec fails here, not as an error of every invoke
+    format_args(args, key=keys[0], i=0, client=0)
+    samples = []
+    sent = [0]
+    start = time.time()
+
+    def more():
+        if duration is not None:
+            return time.time() - start < duration
+        return sent[0] < invokes
+
+    async def client(c):
+        while more():
+            i = sent[0]
+            sent[0] += 1
+            key = rng.choice(keys)
+            if rate_limiter:
+                await rate_limiter.wait()
+
+            invoke_start = time.time()
+            error = None
+            try:
+                response = await chaincode_invoke(
+                    cli,
+                    requestor=requestor,
+                    channel_name=channel_name,
+                    peers=peers,
+                    fcn=fcn,
+                    args=[json.dumps(format_args(args, key=key, i=i, client=c))],
+                    cc_name=chaincode_name,
+                    timeout=timeout,
+                    selector=selector
+                )
+            except Exception as e:
+                outcome = classify_error(e)
+                if outcome == 'ERROR':
+                    error = repr(e)
+            else:
+                outcome = classify(response)
+
+            samples.append({'client': c, 'key': key, 'outcome': outcome, 'start': invoke_start - start,
+                            'latency': time.time() - invoke_start, 'error': error})
+
+    await asyncio.gather(*[client(c) for c in range(clients)])
+
+    return samples, time.time() - start
+
+
+def benchmark_contention(cli, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    try:
+        return loop.run_until_complete(run_contention(cli, *args, **kwargs))
+    finally:
+        loop.run_until_complete(close_block_listeners())
@@ -0,0 +1,71 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+
+from hfc.util.utils import CC_TYPE_GOLANG, package_chaincode
+
+from .common_utils import create_directory
+
+SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
+CHAINCODE_CACHE_PATH = os.getenv('CHAINCODE_CACHE_PATH', f'{SUBSTRA_PATH}/data/chaincode')
+
+# in process cache, keyed by source tree hash
+packages = {}
+
+
+def hash_chaincode(cc_path):
+    # hash what package_chaincode puts in the archive: paths relative to GOPATH (src/<cc_path>/...) and file
+    # contents (tar headers are zeroed by the sdk so nothing else ends up in the package)
+    go_path = os.environ['GOPATH']
+    proj_path = os.path.join(go_path, 'src', cc_path)
+
+    sha = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(proj_path):
+        dir_names.sort()
+        for filename in sorted(file_names):
+            file_path = os.path.join(dir_path, filename)
+            sha.update(os.path.relpath(file_path, go_path).encode('utf-8') + b'\0')
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+            sha.update(b'\0')
+
+    return sha.hexdigest()
+
+
+def get_chaincode_package(cc_path, cache_path=CHAINCODE_CACHE_PATH):
+    digest = hash_chaincode(cc_path)
+
+    if digest in packages:
+        return packages[digest]
+
+    filename = os.path.join(cache_path, f'{digest}.tar.gz')
+
+    if os.path.exists(filename):
+        print(f'Using cached chaincode package {filename}', flush=True)
+        with open(filename, 'rb') as f:
+            packages[digest] = f.read()
+    else:
+        print(f'Packaging chaincode {cc_path} to {filename}', flush=True)
+        packages[digest] = package_chaincode(cc_path, CC_TYPE_GOLANG)
+
+        create_directory(cache_path)
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(packages[digest])
+        os.replace(tmp_filename, filename)
+
+    return packages[digest]
@@ -12,53 +12,416 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import itertools
 import os
+import threading
+import time
 
+import aiogrpc
+import grpc
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from hfc.fabric import Client
 from hfc.fabric.orderer import Orderer
 from hfc.fabric.organization import create_org
 from hfc.fabric.peer import Peer
-from hfc.fabric.user import create_user
+from hfc.fabric.user import User, validate
+from hfc.fabric_ca.caservice import Enrollment
+from hfc.util.crypto.crypto import ecies
+from hfc.protos.discovery import protocol_pb2_grpc
+from hfc.protos.orderer import ab_pb2_grpc
+from hfc.protos.peer import peer_pb2_grpc, events_pb2_grpc
 from hfc.util.keyvaluestore import FileKeyValueStore
+from hfc.util.policies import s2d
+
+from .config_utils import load_conf, load_conf_index
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
 
+GRPC_OPTIONS = [
+    # fabric peers and orderers reject pings more frequent than peer.keepalive.minInterval (60s)
+    ('grpc.keepalive_time_ms', 120000),
+    ('grpc.keepalive_timeout_ms', 20000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    # same limits as fabric
+    ('grpc.max_send_message_length', 100 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 100 * 1024 * 1024),
+]
+
+# one grpc channel (http2 connection) per endpoint and tls credentials, shared by every peer/orderer object,
+# endorsements, broadcasts and event hubs of the process
+channel_pool = {}
+channel_metrics = {}
+channel_pool_lock = threading.Lock()
+
+
+class EndpointMetrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.streams = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.latency = 0
+
+    def start(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return time.time()
+
+    def done(self, start, error):
+        with self._lock:
+            self.in_flight -= 1
+            self.errors += int(error)
+            self.latency += time.time() - start
+
+    def stream(self):
+        with self._lock:
+            self.streams += 1
+
+    def __str__(self):
+        mean = self.latency / (self.calls - self.in_flight) if self.calls > self.in_flight else 0
+        return (f'{self.calls} calls, {self.errors} errors, {self.streams} streams, '
+                f'mean latency {mean * 1000:.1f}ms, max in flight {self.max_in_flight}')
+
+
+class MetricsInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.UnaryStreamClientInterceptor,
+                         grpc.StreamStreamClientInterceptor):
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        start = self._metrics.start()
+        call = continuation(client_call_details, request)
+        call.add_done_callback(lambda c: self._metrics.done(start, c.exception() is not None))
+        return call
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        self._metrics.stream()
+        return continuation(client_call_details, request)
+
+    def intercept_stream_stream(self, continuation, client_call_details, request_iterator):
+        self._metrics.stream()
+        return continuation(client_call_details, request_iterator)
+
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def get_grpc_channel(endpoint, tls_ca_cert_file, client_key_file, client_cert_file):
+    key = (endpoint, tls_ca_cert_file, client_key_file, client_cert_file)
+
+    with channel_pool_lock:
+        if key not in channel_pool:
+            credentials = grpc.ssl_channel_credentials(read_file(tls_ca_cert_file),
+                                                       private_key=read_file(client_key_file),
+                                                       certificate_chain=read_file(client_cert_file))
+            metrics = channel_metrics.setdefault(endpoint, EndpointMetrics())
+            channel = grpc.intercept_channel(grpc.secure_channel(endpoint, credentials, GRPC_OPTIONS),
+                                             MetricsInterceptor(metrics))
+            channel_pool[key] = aiogrpc.Channel(channel)
+
+    return channel_pool[key]
+
+
+def create_peer(name, endpoint, tls_ca_cert_file, client_key_file, client_cert_file):
+    # the sdk opens its own channel, which is lazy and never used: it does not connect
+    peer = Peer(name=name, endpoint=endpoint)
+    peer._tls_ca_certs_path = tls_ca_cert_file
+    peer._client_key_path = client_key_file
+    peer._client_cert_path = client_cert_file
+    peer._channel = get_grpc_channel(endpoint, tls_ca_cert_file, client_key_file, client_cert_file)
+    peer._endorser_client = peer_pb2_grpc.EndorserStub(peer._channel)
+    peer._discovery_client = protocol_pb2_grpc.DiscoveryStub(peer._channel)
+    peer._event_client = events_pb2_grpc.DeliverStub(peer._channel)
+    return peer
+
+
+def create_orderer(name, endpoint, tls_ca_cert_file, client_key_file, client_cert_file):
+    orderer = Orderer(name, endpoint=endpoint)
+    orderer._tls_ca_certs_path = tls_ca_cert_file
+    orderer._client_key_path = client_key_file
+    orderer._client_cert_path = client_cert_file
+    orderer._channel = get_grpc_channel(endpoint, tls_ca_cert_file, client_key_file, client_cert_file)
+    orderer._orderer_client = ab_pb2_grpc.AtomicBroadcastStub(orderer._channel)
+    return orderer
+
+
+def print_channel_metrics():
+    for endpoint, metrics in sorted(channel_metrics.items()):
+        print(f'{endpoint}: {metrics}', flush=True)
+
+
+# endorsement policy of the chaincode: a member of any of the orgs
+def make_policy(orgs_mspid):
+    roles = [f"'{x}.member'" for x in orgs_mspid]
+    return s2d().parse(f"OR({', '.join(roles)})")
+
+
+PEER_SELECTION = os.getenv('PEER_SELECTION', 'least-outstanding')
+PEER_SELECTIONS = ('round-robin', 'least-outstanding', 'ewma')
+EWMA_ALPHA = 0.3
+UNHEALTHY_DELAY = 1
+MAX_UNHEALTHY_DELAY = 30
+
+
+class PeerUnavailable(Exception):
+    pass
+
+
+class PeerStats(object):
+    # endorsements sent to a peer by the whole process: pending ones, latency and health
+    def __init__(self):
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.unhealthy_until = 0
+
+    def healthy(self):
+        return time.time() >= self.unhealthy_until
+
+    def done(self, elapsed, failed):
+        self.outstanding -= 1
+        if failed:
+            # skipped for a while, longer after every failure in a row, then tried again
+            self.failures += 1
+            self.unhealthy_until = time.time() + min(MAX_UNHEALTHY_DELAY, UNHEALTHY_DELAY * 2 ** (self.failures - 1))
+        else:
+            self.failures = 0
+            self.unhealthy_until = 0
+            self.latency = elapsed if self.latency is None else EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * self.latency
+
+    def __str__(self):
+        latency = f'{self.latency * 1000:.1f}ms' if self.latency is not None else '-'
+        return (f'{self.outstanding} outstanding, latency {latency}, '
+                f"{'healthy' if self.healthy() else f'unhealthy ({self.failures} failures)'}")
+
+
+peer_stats = {}
+
+
+def get_peer_stats(peer):
+    return peer_stats.setdefault(peer.name, PeerStats())
+
+
+# Chooses the endorsing peers of a transaction among the peers of orgs {mspid: [peer]}: one peer for each of the
+# orgs needed to satisfy the endorsement policy (as built by make_policy), the fewest orgs possible, and among
+# the peers of an org:
+#   round-robin: the next one
+#   least-outstanding: the one with the fewest pending endorsements
+#   ewma: the one with the lowest latency (moving average) weighted by its pending endorsements, the ones not
+#     measured yet first
+# Peers whose last endorsements failed to connect are skipped for a while, unless the whole org is
+class PeerSelector(object):
+    def __init__(self, peers, policy, strategy=PEER_SELECTION):
+        if strategy not in PEER_SELECTIONS:
+            raise ValueError(f'Unknown peer selection {strategy}, expected one of {PEER_SELECTIONS}')
+
+        self.peers = peers
+        self.policy = policy
+        self.strategy = strategy
+        self.cycles = {mspid: itertools.cycle(range(len(org_peers))) for mspid, org_peers in peers.items()}
+
+    def score(self, peer):
+        stats = get_peer_stats(peer)
+        if self.strategy == 'least-outstanding':
+            return stats.outstanding
+        if self.strategy == 'ewma':
+            return (stats.latency or 0) * (stats.outstanding + 1)
+        return 0
+
+    def select_org_peer(self, mspid):
+        org_peers = self.peers[mspid]
+        # rotating the candidates breaks ties, and is the whole round-robin
+        start = next(self.cycles[mspid])
+        candidates = org_peers[start:] + org_peers[:start]
+
+        healthy = [peer for peer in candidates if get_peer_stats(peer).healthy()]
+        if not healthy:
+            return min(candidates, key=lambda peer: get_peer_stats(peer).unhealthy_until)
+        return min(healthy, key=self.score)
+
+    def required_orgs(self, rule=None):
+        # smallest set of orgs found satisfying the rule, None if it cannot be
+        rule = rule or self.policy['policy']
+
+        if 'signed-by' in rule:
+            mspid = self.policy['identities'][rule['signed-by']]['role']['mspId']
+            return {mspid} if self.peers.get(mspid) else None
+
+        n_of = next(k for k in rule if k.endswith('-of'))
+        n = int(n_of.split('-')[0])
+        options = sorted((orgs for orgs in map(self.required_orgs, rule[n_of]) if orgs is not None), key=len)
+        if len(options) < n:
+            return None
+        return set().union(*options[:n])
+
+    def select(self):
+        orgs = self.required_orgs()
+        if orgs is None:
+            raise PeerUnavailable(f'No peers to satisfy the endorsement policy {self.policy}')
+        return [self.select_org_peer(mspid) for mspid in sorted(orgs)]
+
+    # call(peers) with the selected peers, again with newly selected ones as long as peers are unavailable
+    async def failover(self, call, attempts=None):
+        attempts = attempts or sum(len(org_peers) for org_peers in self.peers.values())
+        for attempt in range(attempts):
+            try:
+                return await call(self.select())
+            except PeerUnavailable as e:
+                if attempt == attempts - 1:
+                    raise
+                print(f'{e}, trying other peers', flush=True)
+
+    # await the endorsement of peers, accounting for it
+    async def track(self, peers, coroutine):
+        stats = [get_peer_stats(peer) for peer in peers]
+        for s in stats:
+            s.outstanding += 1
+
+        start = time.time()
+        failed = False
+        try:
+            return await coroutine
+        except (grpc.RpcError, OSError, asyncio.TimeoutError) as e:
+            failed = True
+            raise PeerUnavailable(f"{', '.join(peer.name for peer in peers)}: {e!r}") from e
+        finally:
+            for s in stats:
+                s.done(time.time() - start, failed)
+
+
+# the peers of orgs, endorsing for their members
+def get_peer_selector(cli, org_names, strategy=PEER_SELECTION):
+    peers = {}
+    mspids = []
+    for org_name in org_names:
+        conf = load_conf(org_name)
+        peers[conf['mspid']] = [cli.get_peer(peer['name']) for peer in conf['peers']]
+        mspids.append(conf['mspid'])
+
+    return PeerSelector(peers, make_policy(mspids), strategy)
+
+
+def print_peer_stats():
+    for name, stats in sorted(peer_stats.items()):
+        print(f'{name}: {stats}', flush=True)
+
+
+# parsed identities and users, loaded once per process
+credentials = {}
+users = {}
+users_lock = threading.RLock()
+
+
+def load_credentials(cert_path, key_path):
+    # files may be replaced, e.g. by a reenroll
+    key = (cert_path, os.stat(cert_path).st_mtime, key_path, os.stat(key_path).st_mtime)
+
+    if key not in credentials:
+        private_key = load_pem_private_key(read_file(key_path), None, default_backend())
+        credentials[key] = (private_key, read_file(cert_path))
+
+    return credentials[key]
+
+
+class MemoryKeyValueStore(dict):
+    def get_value(self, key):
+        return self.get(key)
+
+    def set_value(self, key, value):
+        self[key] = value
+        return True
+
+
+def load_user(name, org, state_store, msp_id, cert_path, key_path):
+    with users_lock:
+        private_key, cert = load_credentials(cert_path, key_path)
+        key = (name, org, id(state_store), msp_id, id(private_key))
+
+        if key not in users:
+            # every User setter saves its whole state, build it in memory and only write it once if it changed
+            memory_store = MemoryKeyValueStore()
+            user = User(name, org, memory_store)
+            user.enrollment = Enrollment(private_key, cert)
+            user.msp_id = msp_id
+            user.cryptoSuite = ecies()
+
+            state = memory_store.get_value(user._state_store_key)
+            if state_store.get_value(user._state_store_key) != state:
+                state_store.set_value(user._state_store_key, state)
+            user._state_store = state_store
+
+            users[key] = validate(user)
+
+        return users[key]
+
+
+class LazyUsers(dict):
+    # users are only read from their msp directory the first time they are asked for
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loaders = {}
+
+    def add(self, name, loader):
+        self._loaders[name] = loader
+        dict.pop(self, name, None)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self._loaders
+
+    def __getitem__(self, name):
+        with users_lock:
+            if name in self._loaders:
+                self[name] = self._loaders.pop(name)()
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+
+def user_loader(cli, org, org_user):
+    org_user_home = org_user['home']
+    org_user_msp_dir = os.path.join(org_user_home, 'msp')
+
+    return lambda: load_user(name=org_user['name'],
+                             org=org['name'],
+                             state_store=cli.state_store,
+                             msp_id=org['mspid'],
+                             cert_path=os.path.join(org_user_msp_dir, 'signcerts', 'cert.pem'),
+                             key_path=os.path.join(org_user_msp_dir, 'keystore', 'key.pem'))
+
 
 def update_cli(cli, orgs):
     for org in orgs:
 
         # add organization
         cli._organizations.update({org['name']: create_org(org['name'], org, cli.state_store)})
+        org_users = LazyUsers(cli._organizations[org['name']]._users)
+        cli._organizations[org['name']]._users = org_users
 
-        # register users except rca boostrap admin
+        # register users except rca boostrap admin, they are loaded on first use
         for user_name in org['users'].keys():
             org_user = org['users'][user_name]
-            org_user_home = org_user['home']
-            org_user_msp_dir = os.path.join(org_user_home, 'msp')
-
-            # register user
-            user_cert_path = os.path.join(org_user_msp_dir, 'signcerts', 'cert.pem')
-            user_key_path = os.path.join(org_user_msp_dir, 'keystore', 'key.pem')
-
-            user = create_user(name=org_user['name'],
-                               org=org['name'],
-                               state_store=cli.state_store,
-                               msp_id=org['mspid'],
-                               cert_path=user_cert_path,
-                               key_path=user_key_path)
-
-            cli._organizations[org['name']]._users.update({org_user['name']: user})
+            org_users.add(org_user['name'], user_loader(cli, org, org_user))
 
         # register orderer
         if 'orderers' in org:
             for o in org['orderers']:
                 tls_orderer_client_dir = os.path.join(o['tls']['dir']['external'], o['tls']['client']['dir'])
-                orderer = Orderer(o['name'],
-                                  endpoint=f"{o['host']}:{o['port']['internal']}",
-                                  tls_ca_cert_file=os.path.join(tls_orderer_client_dir, o['tls']['client']['ca']),
-                                  client_cert_file=os.path.join(tls_orderer_client_dir, o['tls']['client']['cert']),
-                                  client_key_file=os.path.join(tls_orderer_client_dir, o['tls']['client']['key']),
-                                  )
+                orderer = create_orderer(
+                    o['name'],
+                    endpoint=f"{o['host']}:{o['port']['internal']}",
+                    tls_ca_cert_file=os.path.join(tls_orderer_client_dir, o['tls']['client']['ca']),
+                    client_cert_file=os.path.join(tls_orderer_client_dir, o['tls']['client']['cert']),
+                    client_key_file=os.path.join(tls_orderer_client_dir, o['tls']['client']['key']))
 
                 cli._orderers.update({o['name']: orderer})
 
@@ -68,11 +431,11 @@ def update_cli(cli, orgs):
                 tls_peer_client_dir = os.path.join(peer['tls']['dir']['external'], peer['tls']['client']['dir'])
 
                 port = peer['port'][os.environ.get('ENV', 'external')]
-                p = Peer(name=peer['name'],
-                         endpoint=f"{peer['host']}:{port}",
-                         tls_ca_cert_file=os.path.join(tls_peer_client_dir, peer['tls']['client']['ca']),
-                         client_cert_file=os.path.join(tls_peer_client_dir, peer['tls']['client']['cert']),
-                         client_key_file=os.path.join(tls_peer_client_dir, peer['tls']['client']['key']))
+                p = create_peer(name=peer['name'],
+                                endpoint=f"{peer['host']}:{port}",
+                                tls_ca_cert_file=os.path.join(tls_peer_client_dir, peer['tls']['client']['ca']),
+                                client_cert_file=os.path.join(tls_peer_client_dir, peer['tls']['client']['cert']),
+                                client_key_file=os.path.join(tls_peer_client_dir, peer['tls']['client']['key']))
                 cli._peers.update({peer['name']: p})
 
         # register system channel
@@ -83,8 +446,78 @@ def update_cli(cli, orgs):
     return cli
 
 
-def init_cli(orgs):
+class LazyRegistry(dict):
+    # orgs, peers and orderers of the cli, the owning org conf is only read and registered
+    # the first time one of them is asked for by name
+    def __init__(self, loader, owners):
+        super().__init__()
+        self._loader = loader
+        self._owners = owners
+
+    def _load(self, name):
+        if not dict.__contains__(self, name) and name in self._owners:
+            self._loader(self._owners[name])
+
+    def _load_all(self):
+        for name in self._owners:
+            self._load(name)
+
+    def __contains__(self, name):
+        self._load(name)
+        return dict.__contains__(self, name)
+
+    def __getitem__(self, name):
+        self._load(name)
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    # iterating needs every entry
+    def __iter__(self):
+        self._load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self._load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+
+def init_lazy_cli(cli, index):
+    loaded = set()
+    lock = threading.RLock()
+
+    def load_org(org_name):
+        with lock:
+            if org_name not in loaded:
+                loaded.add(org_name)
+                update_cli(cli, [load_conf(org_name, index)])
+
+    cli._organizations = LazyRegistry(load_org, {name: name for name in index['orgs']})
+    cli._peers = LazyRegistry(load_org, index['peers'])
+    cli._orderers = LazyRegistry(load_org, index['orderers'])
+
+    return cli
+
+
+# without orgs, they are registered on first access by name from the conf index
+def init_cli(orgs=None):
     cli = Client()
     cli._state_store = FileKeyValueStore('/tmp/kvs/')
 
+    if orgs is None:
+        return init_lazy_cli(cli, load_conf_index())
+
     return update_cli(cli, orgs)
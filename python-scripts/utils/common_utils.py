@@ -12,60 +12,187 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import ctypes
+import ctypes.util
 import os
-import socket
+import random
+import select
+import ssl
 
 import time
 from subprocess import call, check_output
 
+# inotify(7) events
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
 
 def create_directory(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
 
+def tls_context(ca_file, cert_file=None, key_file=None):
+    context = ssl.create_default_context(cafile=ca_file)
+    if cert_file and key_file:
+        context.load_cert_chain(cert_file, key_file)
+    # grpc servers only accept http2
+    context.set_alpn_protocols(['h2'])
+    return context
+
+
+# One readiness attempt
+# check can be 'tcp' (port open) or 'tls' (tls handshake, grpc endpoints)
+async def probe(endpoint, timeout):
+    ssl_context = endpoint.get('ssl') if endpoint.get('check') == 'tls' else None
+
+    _, writer = await asyncio.wait_for(
+        asyncio.open_connection(endpoint['host'], endpoint['port'], ssl=ssl_context,
+                                server_hostname=endpoint['host'] if ssl_context else None),
+        timeout)
+
+    try:
+        if ssl_context and writer.get_extra_info('ssl_object').selected_alpn_protocol() != 'h2':
+            raise ConnectionError('endpoint does not speak grpc')
+    finally:
+        writer.close()
+
+
+# Wait for an endpoint with an exponential backoff (with jitter) capped at max_delay
+async def wait_endpoint(endpoint, secs, max_delay=0.5):
+    start = time.time()
+    attempts = 0
+    error = None
+
+    while True:
+        attempts += 1
+        remaining = secs - (time.time() - start)
+        try:
+            await probe(endpoint, max(min(1, remaining), 0.1))
+        except (OSError, asyncio.TimeoutError, ssl.SSLError) as e:
+            error = str(e) or e.__class__.__name__
+        else:
+            return dict(endpoint, ready=True, attempts=attempts, elapsed=time.time() - start, error=None)
+
+        if time.time() - start > secs:
+            return dict(endpoint, ready=False, attempts=attempts, elapsed=time.time() - start, error=error)
+
+        await asyncio.sleep(min(max_delay, 0.05 * 2 ** attempts) * random.uniform(0.5, 1))
+
+
+# Wait for several endpoints at once
+# endpoint: {'what': ..., 'host': ..., 'port': ..., 'check': 'tcp'|'tls', 'ssl': ...}
+def wait_endpoints(endpoints, secs, logFile=None):
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(asyncio.gather(*[wait_endpoint(endpoint, secs) for endpoint in endpoints]))
+
+    for result in results:
+        if result['ready']:
+            print('%(what)s is ready (%(elapsed).2fs, %(attempts)s attempts)' % result, flush=True)
+        else:
+            print('Failed waiting for %(what)s: %(error)s; see %(logFile)s' % dict(result, logFile=logFile),
+                  flush=True)
+
+    return results
+
+
 # Wait for a process to begin to listen on a particular host and port
 # Usage: waitPort <what> <timeoutInSecs> <errorLogFile> <host> <port>
 def waitPort(what, secs, logFile, host, port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex((host, port))
+    print('Waiting for %s ...' % what, flush=True)
+    result = wait_endpoints([{'what': what, 'host': host, 'port': port, 'check': 'tcp'}], secs, logFile)[0]
+    return result['ready']
+
+
+# Containers touch <stage>.fail instead of <stage>.successful when they fail
+def fail_marker(file):
+    base, ext = os.path.splitext(file)
+    return f'{base}.fail' if ext == '.successful' else None
+
+
+def remove_fail_markers(files):
+    for file in filter(None, map(fail_marker, files)):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None, None
+
+    if fd < 0:
+        return None, None
+
+    return libc, fd
+
+
+# Wait for a set of files to exist, waking up as soon as one is created (inotify, or polling when unavailable)
+# Returns {file: {'status': 'created'|'failed'|'timeout', 'elapsed': secs}}
+def wait_files(files, secs, poll_interval=0.1):
+    start = time.time()
+    results = {}
+    pending = set(files)
+    libc, fd = inotify()
+    watched = set()
+
+    try:
+        while pending:
+            # watch before checking so that no creation is missed in between
+            # directories which do not exist yet cannot be watched, they are tried again on next loop
+            if fd is not None:
+                for directory in {os.path.dirname(os.path.abspath(file)) for file in pending} - watched:
+                    if libc.inotify_add_watch(fd, directory.encode('utf-8'), IN_CREATE | IN_MOVED_TO) >= 0:
+                        watched.add(directory)
+
+            for file in list(pending):
+                failed = fail_marker(file)
+                if os.path.exists(file):
+                    results[file] = {'status': 'created', 'elapsed': time.time() - start}
+                elif failed and os.path.exists(failed):
+                    results[file] = {'status': 'failed', 'elapsed': time.time() - start}
+                else:
+                    continue
+                pending.remove(file)
+
+            remaining = secs - (time.time() - start)
+            if not pending or remaining <= 0:
+                break
 
-    if result != 0:
-        print('Waiting for %s ...' % what, flush=True)
-        starttime = int(time.time())
+            if fd is None:
+                time.sleep(min(poll_interval, remaining))
+                continue
 
-        while True:
-            call(['sleep', '1'])
-            result = sock.connect_ex((host, port))
-            if result == 0:
-                break
+            unwatched = {os.path.dirname(os.path.abspath(file)) for file in pending} - watched
+            if select.select([fd], [], [], min(poll_interval if unwatched else 1, remaining))[0]:
+                try:
+                    os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    pass
+    finally:
+        if fd is not None:
+            os.close(fd)
 
-            if int(time.time()) - starttime > secs:
-                print('Failed waiting for %(what)s; see %(logFile)s' % {'what': what, 'logFile': logFile}, flush=True)
+    for file in pending:
+        results[file] = {'status': 'timeout', 'elapsed': time.time() - start}
 
-            print('.', end='', flush=True)
+    return results
 
 
 # Wait for one or more files to exist
 def dowait(what, secs, logFile, files):
-    logit = True
-    starttime = int(time.time())
-
-    for file in files:
-        while not os.path.exists(file):
-            if logit:
-                print('Waiting for %s ...\n' % what, flush=True)
-                logit = False
-
-            time.sleep(1)
-
-            if int(time.time()) - starttime > secs:
-                print('Failed waiting for %(what)s; see %(logFile)s\n' % {'what': what, 'logFile': logFile}, flush=True)
-                return False
+    print('Waiting for %s ...' % what, flush=True)
+    results = wait_files(files, secs)
 
-            print('.', end='', flush=True)
+    for file, result in results.items():
+        print('  %s: %s (%.2fs)' % (file, result['status'], result['elapsed']), flush=True)
 
-    print('')
+    if any(result['status'] != 'created' for result in results.values()):
+        print('Failed waiting for %(what)s; see %(logFile)s\n' % {'what': what, 'logFile': logFile}, flush=True)
+        return False
 
     return True
 
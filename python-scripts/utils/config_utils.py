@@ -12,22 +12,126 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import glob
 import os
 import json
+from copy import deepcopy
+from functools import lru_cache
 
 from .common_utils import create_directory
 
-from yaml import load, dump, FullLoader
+from yaml import load, dump
+
+try:
+    # libyaml bindings, much faster on the big fabric templates
+    from yaml import CFullLoader as TemplateLoader, CDumper as TemplateDumper
+except ImportError:
+    from yaml import FullLoader as TemplateLoader, Dumper as TemplateDumper
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
+templates_path = os.path.join(dir_path, '../../templates')
 
 SUBSTRA_PATH = os.getenv('SUBSTRA_PATH', '/substra')
+CONF_PATH = f'{SUBSTRA_PATH}/conf/config'
+
+
+# config files (re)written by this process
+written_files = set()
+
+
+# Templates are parsed once per process, callers get their own copy to override
+@lru_cache(maxsize=None)
+def parse_template(name):
+    with open(os.path.join(templates_path, name), 'r') as stream:
+        return load(stream, Loader=TemplateLoader)
+
+
+def load_template(name):
+    return deepcopy(parse_template(name))
+
+
+# Only write when the generated content differs from what is on disk, so that unchanged files keep their mtime
+# and callers can know which services actually need to be restarted (see written_files)
+def write_config(filename, content):
+    filename = os.path.normpath(filename)
+
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            if f.read() == content:
+                return False
+
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+    written_files.add(filename)
+    return True
+
+
+def write_yaml(filename, yaml_data):
+    return write_config(filename, dump(yaml_data, Dumper=TemplateDumper, default_flow_style=False))
+
+
+# index of conf files: {'orgs': {name: {'path', 'type'}}, 'peers': {name: org}, 'orderers': {name: org}}
+# orgs are kept in conf files creation order
+def write_conf_index(conf_path=CONF_PATH):
+    files = glob.glob(os.path.join(conf_path, 'conf-*.json'))
+    files.sort(key=os.path.getmtime)
+
+    index = {'orgs': {}, 'peers': {}, 'orderers': {}}
+    for file_path in files:
+        with open(file_path, 'r') as f:
+            conf = json.load(f)
+        index['orgs'][conf['name']] = {'path': file_path, 'type': conf['type']}
+        for kind in ('peers', 'orderers'):
+            for node in conf.get(kind, []):
+                index[kind][node['name']] = conf['name']
+
+    index_path = os.path.join(conf_path, 'index.json')
+    if not write_config(index_path, json.dumps(index, indent=4)):
+        # up to date, but still has to look newer than the conf files
+        os.utime(index_path)
+
+    return index
+
+
+def load_conf_index(conf_path=CONF_PATH):
+    index_path = os.path.join(conf_path, 'index.json')
+
+    # rebuild the index if it is missing or if a conf file has been (re)generated since
+    try:
+        index_mtime = os.path.getmtime(index_path)
+    except OSError:
+        return write_conf_index(conf_path)
+
+    if any(os.path.getmtime(file_path) > index_mtime
+           for file_path in glob.glob(os.path.join(conf_path, 'conf-*.json'))):
+        return write_conf_index(conf_path)
+
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+confs = {}
+
+
+def load_conf(name, index=None):
+    if name not in confs:
+        index = index or load_conf_index()
+        with open(index['orgs'][name]['path'], 'r') as f:
+            confs[name] = json.load(f)
+    return confs[name]
+
+
+def load_confs(org_type=None, index=None):
+    index = index or load_conf_index()
+    return [load_conf(name, index) for name, org in index['orgs'].items() if org_type in (None, org['type'])]
 
 
 def create_ca_server_config(org):
     # For org, create a config file from template
-    stream = open(os.path.join(dir_path, '../../templates/fabric-ca-server-config.yaml'), 'r')
-    yaml_data = load(stream, Loader=FullLoader)
+    yaml_data = load_template('fabric-ca-server-config.yaml')
 
     # override template here
     yaml_data['tls']['certfile'] = org['tls']['certfile']['internal']
@@ -45,14 +149,12 @@ def create_ca_server_config(org):
     yaml_data['affiliations'] = org['ca']['affiliations']
 
     filename = org['ca']['server-config-path']
-    with open(filename, 'w+') as f:
-        f.write(dump(yaml_data, default_flow_style=False))
+    write_yaml(filename, yaml_data)
 
 
 def create_ca_client_config(org):
     # For org, create a config file from template
-    stream = open(os.path.join(dir_path, '../../templates/fabric-ca-client-config.yaml'), 'r')
-    yaml_data = load(stream, Loader=FullLoader)
+    yaml_data = load_template('fabric-ca-client-config.yaml')
 
     # override template here
     # https://hyperledger-fabric-ca.readthedocs.io/en/release-1.2/users-guide.html#enabling-tls
@@ -67,14 +169,12 @@ def create_ca_client_config(org):
     yaml_data['url'] = org['ca']['url']
 
     filename = org['ca']['client-config-path']
-    with open(filename, 'w+') as f:
-        f.write(dump(yaml_data, default_flow_style=False))
+    write_yaml(filename, yaml_data)
 
 
 def create_configtx(org, filename, raft=True):
 
-    stream = open(os.path.join(dir_path, '../../templates/configtx.yaml'), 'r')
-    yaml_data = load(stream, Loader=FullLoader)
+    yaml_data = load_template('configtx.yaml')
 
     # override template here
 
@@ -114,13 +214,11 @@ def create_configtx(org, filename, raft=True):
 
     yaml_data['Organizations'] = [configtx_org]
 
-    with open(filename, 'w+') as f:
-        f.write(dump(yaml_data, default_flow_style=False))
+    write_yaml(filename, yaml_data)
 
 
 def create_core_config(org, peer, metrics='prometheus'):
-    stream = open(os.path.join(dir_path, '../../templates/core.yaml'), 'r')
-    yaml_data = load(stream, Loader=FullLoader)
+    yaml_data = load_template('core.yaml')
 
     tls_server_dir = f"{peer['tls']['dir']['internal']}/{peer['tls']['server']['dir']}"
     tls_client_dir = f"{peer['tls']['dir']['internal']}/{peer['tls']['client']['dir']}"
@@ -164,11 +262,10 @@ def create_core_config(org, peer, metrics='prometheus'):
     yaml_data['vm']['endpoint'] = 'unix:///host/var/run/docker.sock'
     yaml_data['vm']['docker']['hostConfig']['NetworkMode'] = 'net_substra'
 
-    peer_core = f'/{SUBSTRA_PATH}/conf/%s/%s' % (org['name'], peer['name'])
+    peer_core = f'{SUBSTRA_PATH}/conf/%s/%s' % (org['name'], peer['name'])
     create_directory(peer_core)
     filename = f"{peer_core}/core.yaml"
-    with open(filename, 'w+') as f:
-        f.write(dump(yaml_data, default_flow_style=False))
+    write_yaml(filename, yaml_data)
 
 
 def create_peer_config(org):
@@ -183,10 +280,9 @@ def create_orderer_config(orderer_conf, metrics='prometheus'):
 
     genesis_bloc_file = orderer_conf['misc']['genesis_bloc_file']['internal']
 
-    stream = open(os.path.join(dir_path, '../../templates/orderer.yaml'), 'r')
-    yaml_data = load(stream, Loader=FullLoader)
-
     for orderer in org['orderers']:
+        yaml_data = load_template('orderer.yaml')
+
         tls_server_dir = f"{orderer['tls']['dir']['internal']}/{orderer['tls']['server']['dir']}"
 
         # override template here
@@ -218,11 +314,7 @@ def create_orderer_config(orderer_conf, metrics='prometheus'):
         dir = os.path.join(SUBSTRA_PATH, 'conf', org['name'], orderer['name'])
         create_directory(dir)
         filename = os.path.join(dir, 'orderer.yaml')
-        with open(filename, 'w+') as f:
-            f.write(dump(yaml_data, default_flow_style=False))
-
-        stream = open(os.path.join(dir_path, '../../templates/core.yaml'), 'r')
-        yaml_data = load(stream, Loader=FullLoader)
+        write_yaml(filename, yaml_data)
 
         # Create core.yaml config for being able to use peer binary for orderer org
         create_core_config(org, orderer)
@@ -282,4 +374,4 @@ def create_substra_backend_config(org, orderer_conf):
             }
         }
     }
-    json.dump(res, open(filename, 'w+'), indent=4)
+    write_config(filename, json.dumps(res, indent=4))
@@ -0,0 +1,381 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process replacement for the `configtxlator proto_encode/compute_update` round trips.
+# Dicts follow the configtxlator (protolator) JSON layout, which is also what `configtxgen -printOrg`
+# outputs and what hfc.fabric.block_decoder.decode_config approximates.
+
+from base64 import b64decode
+
+from google.protobuf import json_format
+
+from hfc.protos.common import common_pb2, configtx_pb2, policies_pb2
+from hfc.protos.common import configuration_pb2 as common_configuration_pb2
+from hfc.protos.msp import identities_pb2, msp_config_pb2, msp_principal_pb2
+from hfc.protos.orderer import configuration_pb2 as orderer_configuration_pb2
+from hfc.protos.peer import configuration_pb2 as peer_configuration_pb2
+
+
+CONFIG_VALUES = {
+    # channel
+    'HashingAlgorithm': common_configuration_pb2.HashingAlgorithm,
+    'BlockDataHashingStructure': common_configuration_pb2.BlockDataHashingStructure,
+    'OrdererAddresses': common_configuration_pb2.OrdererAddresses,
+    'Consortium': common_configuration_pb2.Consortium,
+    'Capabilities': common_configuration_pb2.Capabilities,
+    # orderer
+    'ConsensusType': orderer_configuration_pb2.ConsensusType,
+    'BatchSize': orderer_configuration_pb2.BatchSize,
+    'BatchTimeout': orderer_configuration_pb2.BatchTimeout,
+    'KafkaBrokers': orderer_configuration_pb2.KafkaBrokers,
+    'ChannelRestrictions': orderer_configuration_pb2.ChannelRestrictions,
+    'Endpoints': common_configuration_pb2.OrdererAddresses,
+    # application
+    'ACLs': peer_configuration_pb2.ACLs,
+    'AnchorPeers': peer_configuration_pb2.AnchorPeers,
+}
+
+
+class NoConfigUpdate(Exception):
+    pass
+
+
+def _to_bytes(value):
+    # configtxlator uses base64 for bytes, block_decoder sometimes leaves PEM as plain text
+    if not value:
+        return b''
+    if isinstance(value, bytes):
+        return value
+    if value.startswith('-----BEGIN'):
+        return value.encode('utf-8')
+    return b64decode(value)
+
+
+def _encode_ou_identifier(ou_identifier):
+    if not ou_identifier:
+        return None
+    if not ou_identifier.get('certificate') and not ou_identifier.get('organizational_unit_identifier'):
+        return None
+
+    return msp_config_pb2.FabricOUIdentifier(
+        certificate=_to_bytes(ou_identifier.get('certificate')),
+        organizational_unit_identifier=ou_identifier.get('organizational_unit_identifier', ''))
+
+
+def encode_fabric_msp_config(msp_config):
+    proto = msp_config_pb2.FabricMSPConfig(name=msp_config.get('name', ''))
+
+    for field in ('root_certs', 'intermediate_certs', 'admins', 'revocation_list',
+                  'tls_root_certs', 'tls_intermediate_certs'):
+        getattr(proto, field).extend([_to_bytes(x) for x in msp_config.get(field) or []])
+
+    signing_identity = msp_config.get('signing_identity')
+    if signing_identity:
+        proto.signing_identity.public_signer = _to_bytes(signing_identity.get('public_signer'))
+        private_signer = signing_identity.get('private_signer') or {}
+        if private_signer:
+            proto.signing_identity.private_signer.key_identifier = private_signer.get('key_identifier', '')
+            # block_decoder masks private key material
+            if private_signer.get('key_material') not in (None, 'private'):
+                proto.signing_identity.private_signer.key_material = _to_bytes(private_signer['key_material'])
+
+    for ou_identifier in msp_config.get('organizational_unit_identifiers') or []:
+        proto.organizational_unit_identifiers.add().CopyFrom(_encode_ou_identifier(ou_identifier))
+
+    crypto_config = msp_config.get('crypto_config')
+    if crypto_config:
+        json_format.ParseDict(crypto_config, proto.crypto_config)
+
+    node_ous = msp_config.get('fabric_node_ous')
+    if node_ous:
+        client_ou = _encode_ou_identifier(node_ous.get('client_ou_identifier'))
+        peer_ou = _encode_ou_identifier(node_ous.get('peer_ou_identifier'))
+        # block_decoder always outputs node ous, even when they are not set
+        if node_ous.get('enable') or client_ou or peer_ou:
+            proto.fabric_node_ous.enable = bool(node_ous.get('enable'))
+            if client_ou:
+                proto.fabric_node_ous.client_ou_identifier.CopyFrom(client_ou)
+            if peer_ou:
+                proto.fabric_node_ous.peer_ou_identifier.CopyFrom(peer_ou)
+
+    return proto
+
+
+def encode_msp_value(value):
+    proto = msp_config_pb2.MSPConfig(type=int(value.get('type', 0)))
+    config = value.get('config')
+    if isinstance(config, dict):
+        if proto.type != 0:
+            raise ValueError(f'Unsupported MSP type {proto.type}')
+        proto.config = encode_fabric_msp_config(config).SerializeToString()
+    else:
+        proto.config = _to_bytes(config)
+    return proto
+
+
+def encode_msp_principal(principal):
+    # block_decoder inlines the serialized identity for IDENTITY principals
+    if 'mspid' in principal:
+        principal = {'principal_classification': 'IDENTITY', 'principal': principal}
+
+    classification = principal.get('principal_classification', 'ROLE')
+    if isinstance(classification, int):
+        classification = msp_principal_pb2.MSPPrincipal.Classification.Name(classification)
+
+    proto = msp_principal_pb2.MSPPrincipal(
+        principal_classification=msp_principal_pb2.MSPPrincipal.Classification.Value(classification))
+
+    content = principal.get('principal') or {}
+    if classification == 'ROLE':
+        message = json_format.ParseDict(content, msp_principal_pb2.MSPRole())
+    elif classification == 'ORGANIZATION_UNIT':
+        message = json_format.ParseDict(content, msp_principal_pb2.OrganizationUnit())
+    else:
+        message = identities_pb2.SerializedIdentity(mspid=content.get('mspid', ''),
+                                                    id_bytes=_to_bytes(content.get('id_bytes')))
+    proto.principal = message.SerializeToString()
+    return proto
+
+
+def encode_policy(policy):
+    proto = policies_pb2.Policy(type=int(policy.get('type', 0)))
+    value = policy.get('value')
+
+    if proto.type == policies_pb2.Policy.SIGNATURE and isinstance(value, dict):
+        envelope = policies_pb2.SignaturePolicyEnvelope(version=int(value.get('version', 0)))
+        json_format.ParseDict(value['rule'], envelope.rule)
+        for identity in value.get('identities') or []:
+            envelope.identities.add().CopyFrom(encode_msp_principal(identity))
+        proto.value = envelope.SerializeToString()
+    elif proto.type == policies_pb2.Policy.IMPLICIT_META and isinstance(value, dict):
+        proto.value = json_format.ParseDict(value, policies_pb2.ImplicitMetaPolicy()).SerializeToString()
+    elif isinstance(value, str):
+        proto.value = _to_bytes(value)
+
+    return proto
+
+
+def encode_config_value(key, value):
+    proto = configtx_pb2.ConfigValue(version=int(value.get('version', 0)),
+                                     mod_policy=value.get('mod_policy', ''))
+    content = value.get('value')
+
+    if not content:
+        return proto
+
+    if key == 'MSP':
+        message = encode_msp_value(content)
+    elif key == 'ChannelCreationPolicy':
+        message = encode_policy(content)
+    elif key in CONFIG_VALUES:
+        if key == 'ConsensusType' and isinstance(content.get('metadata'), dict):
+            raise ValueError('ConsensusType metadata must be provided as base64 encoded bytes')
+        message = json_format.ParseDict(content, CONFIG_VALUES[key]())
+    else:
+        raise ValueError(f'Unsupported config value {key}')
+
+    proto.value = message.SerializeToString()
+    return proto
+
+
+def encode_config_policy(policy):
+    proto = configtx_pb2.ConfigPolicy(version=int(policy.get('version', 0)),
+                                      mod_policy=policy.get('mod_policy', ''))
+    if policy.get('policy'):
+        proto.policy.CopyFrom(encode_policy(policy['policy']))
+    return proto
+
+
+def encode_config_group(group):
+    proto = configtx_pb2.ConfigGroup()
+    if not group:
+        return proto
+
+    proto.version = int(group.get('version', 0))
+    proto.mod_policy = group.get('mod_policy') or ''
+
+    for name, sub_group in (group.get('groups') or {}).items():
+        proto.groups[name].CopyFrom(encode_config_group(sub_group))
+    for name, value in (group.get('values') or {}).items():
+        proto.values[name].CopyFrom(encode_config_value(name, value))
+    for name, policy in (group.get('policies') or {}).items():
+        proto.policies[name].CopyFrom(encode_config_policy(policy))
+
+    return proto
+
+
+def encode_config(config):
+    proto = configtx_pb2.Config(sequence=int(config.get('sequence', 0)))
+    proto.channel_group.CopyFrom(encode_config_group(config['channel_group']))
+    return proto
+
+
+# Port of fabric common/tools/configtxlator/update.Compute
+
+def _compute_items_map_update(original, updated, is_same, make):
+    read_set, write_set, same_set = {}, {}, {}
+    members_updated = False
+
+    for name, original_item in original.items():
+        if name not in updated:
+            members_updated = True
+            continue
+
+        updated_item = updated[name]
+        if is_same(original_item, updated_item):
+            same_set[name] = make(version=original_item.version)
+            continue
+
+        write_set[name] = make(updated_item, version=original_item.version + 1)
+
+    for name, updated_item in updated.items():
+        if name in original:
+            continue
+        members_updated = True
+        write_set[name] = make(updated_item, version=0)
+
+    return read_set, write_set, same_set, members_updated
+
+
+def _make_policy(item=None, version=0):
+    policy = configtx_pb2.ConfigPolicy(version=version)
+    if item is not None:
+        policy.mod_policy = item.mod_policy
+        if item.HasField('policy'):
+            policy.policy.CopyFrom(item.policy)
+    return policy
+
+
+def _make_value(item=None, version=0):
+    value = configtx_pb2.ConfigValue(version=version)
+    if item is not None:
+        value.mod_policy = item.mod_policy
+        value.value = item.value
+    return value
+
+
+def _compute_policies_map_update(original, updated):
+    return _compute_items_map_update(
+        original, updated,
+        lambda o, u: o.mod_policy == u.mod_policy and o.policy == u.policy,
+        _make_policy)
+
+
+def _compute_values_map_update(original, updated):
+    return _compute_items_map_update(
+        original, updated,
+        lambda o, u: o.mod_policy == u.mod_policy and o.value == u.value,
+        _make_value)
+
+
+def _compute_groups_map_update(original, updated):
+    read_set, write_set, same_set = {}, {}, {}
+    members_updated = False
+
+    for name, original_group in original.items():
+        if name not in updated:
+            members_updated = True
+            continue
+
+        group_read_set, group_write_set, group_updated = _compute_group_update(original_group, updated[name])
+        if not group_updated:
+            same_set[name] = group_read_set
+            continue
+
+        read_set[name] = group_read_set
+        write_set[name] = group_write_set
+
+    for name, updated_group in updated.items():
+        if name in original:
+            continue
+        members_updated = True
+        _, group_write_set, _ = _compute_group_update(configtx_pb2.ConfigGroup(), updated_group)
+        group_write_set.version = 0
+        group_write_set.mod_policy = updated_group.mod_policy
+        write_set[name] = group_write_set
+
+    return read_set, write_set, same_set, members_updated
+
+
+def _make_group(version, policies, values, groups, mod_policy=''):
+    group = configtx_pb2.ConfigGroup(version=version, mod_policy=mod_policy)
+    for name, policy in policies.items():
+        group.policies[name].CopyFrom(policy)
+    for name, value in values.items():
+        group.values[name].CopyFrom(value)
+    for name, sub_group in groups.items():
+        group.groups[name].CopyFrom(sub_group)
+    return group
+
+
+def _compute_group_update(original, updated):
+    read_policies, write_policies, same_policies, policies_updated = _compute_policies_map_update(
+        original.policies, updated.policies)
+    read_values, write_values, same_values, values_updated = _compute_values_map_update(
+        original.values, updated.values)
+    read_groups, write_groups, same_groups, groups_updated = _compute_groups_map_update(
+        original.groups, updated.groups)
+
+    if not (policies_updated or values_updated or groups_updated or original.mod_policy != updated.mod_policy):
+
+        if not any([read_policies, write_policies, read_values, write_values, read_groups, write_groups]):
+            return (configtx_pb2.ConfigGroup(version=original.version),
+                    configtx_pb2.ConfigGroup(version=original.version),
+                    False)
+
+        return (_make_group(original.version, read_policies, read_values, read_groups),
+                _make_group(original.version, write_policies, write_values, write_groups),
+                True)
+
+    for same_set, read_set, write_set in ((same_policies, read_policies, write_policies),
+                                          (same_values, read_values, write_values),
+                                          (same_groups, read_groups, write_groups)):
+        read_set.update(same_set)
+        write_set.update(same_set)
+
+    return (_make_group(original.version, read_policies, read_values, read_groups),
+            _make_group(original.version + 1, write_policies, write_values, write_groups, updated.mod_policy),
+            True)
+
+
+def compute_update(channel_id, original, updated):
+    if isinstance(original, dict):
+        original = encode_config(original)
+    if isinstance(updated, dict):
+        updated = encode_config(updated)
+
+    read_set, write_set, group_updated = _compute_group_update(original.channel_group, updated.channel_group)
+    if not group_updated:
+        raise NoConfigUpdate('No differences detected between original and updated config')
+
+    config_update = configtx_pb2.ConfigUpdate(channel_id=channel_id)
+    config_update.read_set.CopyFrom(read_set)
+    config_update.write_set.CopyFrom(write_set)
+    return config_update
+
+
+def create_config_update_envelope(channel_id, config_update):
+    # same unsigned envelope as `configtxlator proto_encode --type common.Envelope` on
+    # {'payload': {'header': {'channel_header': {'channel_id': ..., 'type': 2}}, 'data': {'config_update': ...}}}
+    config_update_envelope = configtx_pb2.ConfigUpdateEnvelope(config_update=config_update.SerializeToString())
+
+    channel_header = common_pb2.ChannelHeader(type=common_pb2.CONFIG_UPDATE, channel_id=channel_id)
+    payload = common_pb2.Payload(data=config_update_envelope.SerializeToString())
+    payload.header.channel_header = channel_header.SerializeToString()
+
+    return common_pb2.Envelope(payload=payload.SerializeToString()).SerializeToString()
+
+
+def compute_update_envelope(channel_id, original, updated):
+    return create_config_update_envelope(channel_id, compute_update(channel_id, original, updated))
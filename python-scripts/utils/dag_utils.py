@@ -0,0 +1,93 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class DAGError(Exception):
+    pass
+
+
+def topological_order(tasks):
+    remaining = {name: set(deps) for name, (_, deps) in tasks.items()}
+
+    unknown = {dep for deps in remaining.values() for dep in deps} - set(tasks)
+    if unknown:
+        raise DAGError(f'Unknown dependencies: {sorted(unknown)}')
+
+    dependents = {name: [] for name in tasks}
+    for name, deps in remaining.items():
+        for dep in deps:
+            dependents[dep].append(name)
+
+    order = [name for name, deps in remaining.items() if not deps]
+    for name in order:
+        for dependent in dependents[name]:
+            remaining[dependent].discard(name)
+            if not remaining[dependent]:
+                order.append(dependent)
+
+    if len(order) < len(tasks):
+        raise DAGError(f'Dependency cycle between: {sorted(set(tasks) - set(order))}')
+
+    return order
+
+
+# Run tasks {name: (func, [dependencies])}, each one as soon as all its dependencies are done
+# A failing task (exception or exit()) skips everything that depends on it
+# Returns {name: {'status': 'done'|'failed'|'skipped', 'elapsed': secs, 'error': ...}}
+def run_dag(tasks, max_workers=None):
+    order = topological_order(tasks)
+    results = {}
+    running = {}
+    starts = {}
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks) or 1) as executor:
+        while len(results) < len(tasks):
+            for name in order:
+                func, deps = tasks[name]
+                if name in results or name in starts:
+                    continue
+
+                if any(results.get(dep, {}).get('status') in ('failed', 'skipped') for dep in deps):
+                    results[name] = {'status': 'skipped', 'elapsed': 0, 'error': None}
+                elif all(results.get(dep, {}).get('status') == 'done' for dep in deps):
+                    print(f'[{name}] started', flush=True)
+                    starts[name] = time.time()
+                    running[executor.submit(func)] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                elapsed = time.time() - starts[name]
+                try:
+                    future.result()
+                except BaseException as e:
+                    results[name] = {'status': 'failed', 'elapsed': elapsed, 'error': repr(e)}
+                    print(f'[{name}] failed after {elapsed:.2f}s: {e!r}', flush=True)
+                else:
+                    results[name] = {'status': 'done', 'elapsed': elapsed, 'error': None}
+                    print(f'[{name}] done in {elapsed:.2f}s', flush=True)
+
+    print(f'Ran {len(tasks)} tasks in {time.time() - start:.2f}s '
+          f'(sequential time {sum(r["elapsed"] for r in results.values()):.2f}s)', flush=True)
+    for name in order:
+        print(f'  {name}: {results[name]["status"]} ({results[name]["elapsed"]:.2f}s)', flush=True)
+
+    return results
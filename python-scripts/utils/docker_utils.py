@@ -15,6 +15,8 @@
 import os
 import yaml
 
+from .config_utils import write_config
+
 HLF_VERSION = '1.4.3'
 
 fabric_base_directory = '/etc/hyperledger/fabric'
@@ -73,6 +75,9 @@ def generate_docker_compose_org(org, conf_orderer, substra_path, network):
                     # chaincode
                     f'{SUBSTRA_CHAINCODE_PATH}:/opt/gopath/src/chaincode',
 
+                    # chaincode packages cache
+                    f'{substra_path}/data/chaincode/:{substra_path}/data/chaincode/',
+
                     # channel
                     f'{substra_path}/data/channel/:{substra_path}/data/channel/',
 
@@ -193,8 +198,7 @@ def generate_docker_compose_org(org, conf_orderer, substra_path, network):
     for name, dconfig in docker_compose['substra_tools'].items():
         COMPOSITION['services'][name] = dconfig
 
-    with open(docker_compose['path'], 'w+') as f:
-        f.write(yaml.dump(COMPOSITION, default_flow_style=False, indent=4, line_break=None))
+    write_config(docker_compose['path'], yaml.dump(COMPOSITION, default_flow_style=False, indent=4, line_break=None))
 
     return docker_compose
 
@@ -324,8 +328,7 @@ def generate_docker_compose_orderer(org, substra_path, network):
     for name, dconfig in docker_compose['substra_tools'].items():
         COMPOSITION['services'][name] = dconfig
 
-    with open(docker_compose['path'], 'w+') as f:
-        f.write(yaml.dump(COMPOSITION, default_flow_style=False, indent=4, line_break=None))
+    write_config(docker_compose['path'], yaml.dump(COMPOSITION, default_flow_style=False, indent=4, line_break=None))
 
     return docker_compose
 
@@ -354,8 +357,7 @@ def generate_docker(substra_path, specs, network):
             network: {'external': True}}
     }
 
-    with open(path, 'w+') as f:
-        f.write(yaml.dump(COMPOSITION, default_flow_style=False, indent=4, line_break=None))
+    write_config(path, yaml.dump(COMPOSITION, default_flow_style=False, indent=4, line_break=None))
 
     return path
 
@@ -0,0 +1,172 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import OrderedDict
+
+from hfc.fabric.channel.channel_eventhub import ChannelEventHub
+from hfc.protos.common.common_pb2 import BlockMetadataIndex, HeaderType
+from hfc.protos.peer.transaction_pb2 import TxValidationCode
+
+ENDORSER_TRANSACTION = HeaderType.Value('ENDORSER_TRANSACTION')
+
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+# validation codes of the last transactions committed, for the ones waited for after their commit
+COMMITTED_CACHE_SIZE = 10000
+
+# Helpers reading full blocks, as decoded by the sdk (ChannelEventHub.connect(filtered=False))
+
+
+def block_number(block):
+    return block['header']['number']
+
+
+def block_transactions(block):
+    # (tx_id, validation code, transaction) of the endorser transactions of the block
+    codes = block['metadata']['metadata'][BlockMetadataIndex.Value('TRANSACTIONS_FILTER')]
+
+    for index, envelope in enumerate(block['data']['data']):
+        channel_header = envelope['payload']['header']['channel_header']
+        if channel_header['type'] != ENDORSER_TRANSACTION:
+            continue
+
+        code = TxValidationCode.Name(codes[index]) if codes else 'VALID'
+        yield channel_header['tx_id'], code, envelope['payload']['data']
+
+
+def transaction_writes(transaction, chaincode_name):
+    # (key, is_delete, value) written in the state of the chaincode
+    for action in transaction.get('actions', []):
+        results = action['payload']['action']['proposal_response_payload']['extension']['results']
+        for ns_rwset in results['ns_rwset']:
+            if ns_rwset['namespace'] != chaincode_name:
+                continue
+            for write in ns_rwset['rwset']['writes']:
+                yield write['key'], write['is_delete'], write['value']
+
+
+def block_writes(block, chaincode_name):
+    # (tx_id, key, is_delete, value) of the committed transactions only, invalid ones did not change the state
+    for tx_id, code, transaction in block_transactions(block):
+        if code != 'VALID':
+            continue
+        for key, is_delete, value in transaction_writes(transaction, chaincode_name):
+            yield tx_id, key, is_delete, value
+
+
+# A deliver stream of filtered blocks kept open on a peer, notifying the transactions waiting for their commit,
+# instead of an event hub connection per transaction
+# When the stream is lost, it reconnects with a backoff and resumes after the last block seen
+class BlockListener(object):
+    def __init__(self, peer, channel_name, requestor, cache_size=COMMITTED_CACHE_SIZE):
+        self.peer = peer
+        self.channel_name = channel_name
+        self.requestor = requestor
+        self.cache_size = cache_size
+        self.waiters = {}
+        self.committed = OrderedDict()
+        self.last_seen = None
+        self.ready = asyncio.Event()
+        self.task = None
+
+    def on_block(self, block):
+        self.last_seen = block['number']
+
+        for transaction in block['filtered_transactions']:
+            tx_id, code = transaction['txid'], transaction['tx_validation_code']
+            self.committed[tx_id] = code
+            for future in self.waiters.pop(tx_id, []):
+                if not future.done():
+                    future.set_result(code)
+
+        while len(self.committed) > self.cache_size:
+            self.committed.popitem(last=False)
+
+        self.ready.set()
+
+    async def listen(self):
+        delay = RECONNECT_DELAY
+
+        while True:
+            last_seen = self.last_seen
+            event_hub = ChannelEventHub(self.peer, self.channel_name, self.requestor)
+            event_hub.registerBlockEvent(unregister=False, onEvent=self.on_block)
+
+            try:
+                # the newest block first, then the blocks following the last one seen
+                await event_hub.connect(start=last_seen + 1 if last_seen is not None else None)
+                error = 'closed'
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = f'lost: {e!r}'
+            finally:
+                if event_hub.stream is not None:
+                    event_hub.disconnect()
+
+            if self.last_seen != last_seen:
+                delay = RECONNECT_DELAY
+            print(f'Block stream on {self.peer.name} {error}, reconnecting in {delay}s', flush=True)
+            await asyncio.sleep(delay)
+            delay = min(MAX_RECONNECT_DELAY, delay * 2)
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.listen())
+        # transactions sent from now on are seen
+        await self.ready.wait()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.wait([self.task])
+            self.task = None
+            self.ready.clear()
+
+    # validation code of the transaction, once committed
+    async def wait_for_tx(self, tx_id, timeout=None):
+        if tx_id in self.committed:
+            return self.committed[tx_id]
+
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(tx_id, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            futures = self.waiters.get(tx_id, [])
+            if future in futures:
+                futures.remove(future)
+            if tx_id in self.waiters and not futures:
+                del self.waiters[tx_id]
+
+
+# one listener per channel and peer, for the whole process
+block_listeners = {}
+
+
+async def get_block_listener(peer, channel_name, requestor):
+    key = (channel_name, peer.name)
+    if key not in block_listeners:
+        block_listeners[key] = BlockListener(peer, channel_name, requestor)
+
+    await block_listeners[key].start()
+    return block_listeners[key]
+
+
+async def close_block_listeners():
+    listeners = list(block_listeners.values())
+    block_listeners.clear()
+    for listener in listeners:
+        await listener.stop()
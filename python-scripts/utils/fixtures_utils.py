@@ -0,0 +1,368 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import os
+import re
+import time
+
+from yaml import load
+
+try:
+    from yaml import CSafeLoader as FixturesLoader
+except ImportError:
+    from yaml import SafeLoader as FixturesLoader
+
+from .cli import get_peer_selector
+from .dag_utils import DAGError, topological_order
+from .events_utils import close_block_listeners
+from .invoke_utils import RETRYABLE, decode_response, invoke, is_committed, retry_stats
+
+MAX_IN_FLIGHT = int(os.getenv('FIXTURES_MAX_IN_FLIGHT', 50))
+
+# A fixture set is a dependency graph {name: fixture}, a fixture being a dict with:
+#   fcn: chaincode function to invoke
+#   org: org of the admin invoking it, on peers of the org chosen by a PeerSelector unless peer is given
+#   args: arguments, or a function of the keys of the fixtures it depends on returning them
+#   deps: names of the fixtures it depends on
+#   key: field of the response holding the key of the created asset ('key', 'keys')
+#   default: key to use if the response does not hold it (asset already exists), or a function of the response
+#
+# Fixture files (yaml or json) describe the same graph as data, see load_fixtures_file
+
+
+class FixtureError(Exception):
+    pass
+
+
+def tuple_key(response, field='tkey'):
+    # the tuple already exists: its key is in the error message
+    return response.split(f'{field}: ')[1][0:-1]
+
+
+def resolve_key(fixture, response):
+    field = fixture.get('key')
+    if field is None:
+        return response
+
+    if isinstance(response, dict) and field in response:
+        return response[field]
+
+    # rejected: without a default, the asset and its key are unknown and the fixtures depending on it cannot run
+    default = fixture.get('default')
+    key = default(response) if callable(default) else default
+    if key is None:
+        raise FixtureError(f'no {field} in response: {response}')
+    return key
+
+
+async def invoke_fixture(cli, fixture, keys, channel_name, chaincode_name, selector):
+    args = fixture['args'](keys) if callable(fixture['args']) else fixture['args']
+
+    # fixtures committed in the same blocks may conflict, they are then invoked again
+    response = await invoke(
+        cli,
+        requestor=cli.get_user(fixture['org'], 'admin'),
+        channel_name=channel_name,
+        peers=[cli.get_peer(fixture['peer'])] if 'peer' in fixture else None,
+        fcn=fixture['fcn'],
+        args=[json.dumps(args)],
+        cc_name=chaincode_name,
+        selector=selector
+    )
+    if response in RETRYABLE:
+        raise FixtureError(f'invalidated with {response}')
+
+    return decode_response(response), is_committed(response)
+
+
+class RateLimiter(object):
+    # spread submissions evenly, at most rate per second
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next = 0
+
+    async def wait(self):
+        now = time.time()
+        self.next = max(self.next, now)
+        delay = self.next - now
+        self.next += self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Every fixture is invoked as soon as the ones it depends on are committed, independent ones concurrently
+# so that their transactions end up in the same blocks
+# At most max_in_flight invokes per org are pending at once (backpressure), submitted at most rate per second,
+# progress and throughput are printed every report_interval seconds
+# Returns ({name: key}, {name: {'status': 'done'|'failed'|'skipped', 'elapsed': secs, 'error': ...,
+#   'committed': whether its transaction was committed, rather than rejected with a known key}})
+async def run_fixtures(cli, fixtures, channel_name='substrachannel', chaincode_name='substracc',
+                       max_in_flight=MAX_IN_FLIGHT, rate=None, report_interval=None, verbose=True):
+    order = topological_order({name: (None, fixture.get('deps', [])) for name, fixture in fixtures.items()})
+    keys = {}
+    results = {}
+    tasks = {}
+    orgs = {fixture['org'] for fixture in fixtures.values()}
+    in_flight = {org: asyncio.Semaphore(max_in_flight) for org in orgs} if max_in_flight else {}
+    selectors = {org: get_peer_selector(cli, [org]) for org in orgs}
+    rate_limiter = RateLimiter(rate) if rate else None
+    counts = {'pending': 0, 'done': 0, 'committed': 0, 'failed': 0, 'skipped': 0}
+    start = time.time()
+
+    async def run(name):
+        fixture = fixtures[name]
+        deps = fixture.get('deps', [])
+
+        if deps:
+            await asyncio.wait([tasks[dep] for dep in deps])
+        if any(results[dep]['status'] != 'done' for dep in deps):
+            results[name] = {'status': 'skipped', 'elapsed': 0, 'error': None, 'committed': False}
+            counts['skipped'] += 1
+            return
+
+        if fixture['org'] in in_flight:
+            await in_flight[fixture['org']].acquire()
+        if rate_limiter:
+            await rate_limiter.wait()
+
+        counts['pending'] += 1
+        invoke_start = time.time()
+        try:
+            response, committed = await invoke_fixture(cli, fixture, keys, channel_name, chaincode_name,
+                                                       selectors[fixture['org']])
+            keys[name] = resolve_key(fixture, response)
+        except Exception as e:
+            elapsed = time.time() - invoke_start
+            results[name] = {'status': 'failed', 'elapsed': elapsed, 'error': repr(e), 'committed': False}
+            print(f"[{name}] {fixture['fcn']} failed after {elapsed:.2f}s: {e!r}", flush=True)
+        else:
+            elapsed = time.time() - invoke_start
+            # a rejected fixture is done when its key is known anyway, e.g. the asset already exists
+            results[name] = {'status': 'done', 'elapsed': elapsed, 'error': None, 'committed': committed}
+            counts['committed'] += committed
+            if verbose:
+                print(f"[{name}] {fixture['fcn']} {'committed' if committed else 'rejected'} in {elapsed:.2f}s: "
+                      f"{response}", flush=True)
+        finally:
+            counts['pending'] -= 1
+            counts[results[name]['status']] += 1
+            if fixture['org'] in in_flight:
+                in_flight[fixture['org']].release()
+
+    async def report():
+        last_done, last_time = 0, start
+        while True:
+            await asyncio.sleep(report_interval)
+            now = time.time()
+            print(f"{counts['done']}/{len(fixtures)} done ({counts['committed']} committed), "
+                  f"{counts['failed']} failed, {counts['skipped']} skipped, {counts['pending']} in flight, "
+                  f"{(counts['committed'] - last_done) / (now - last_time):.1f} tps "
+                  f"(mean {counts['committed'] / (now - start):.1f} tps)", flush=True)
+            last_done, last_time = counts['committed'], now
+
+    reporter = asyncio.ensure_future(report()) if report_interval else None
+
+    # dependencies first, so that their task exists when a fixture waits for it
+    for name in order:
+        tasks[name] = asyncio.ensure_future(run(name))
+    await asyncio.gather(*tasks.values())
+
+    if reporter:
+        reporter.cancel()
+
+    elapsed = time.time() - start
+    print(f'Loaded {len(fixtures)} fixtures in {elapsed:.2f}s, {counts["done"]} done '
+          f'({counts["committed"]} committed), {counts["failed"]} failed, {counts["skipped"]} skipped, '
+          f'{counts["committed"] / elapsed:.1f} tps '
+          f'(sequential time {sum(r["elapsed"] for r in results.values()):.2f}s)', flush=True)
+    if verbose:
+        retry_stats.print()
+        for name in order:
+            print(f'  {name}: {results[name]["status"]} ({results[name]["elapsed"]:.2f}s)', flush=True)
+
+    return keys, results
+
+
+def load_fixtures(cli, fixtures, channel_name='substrachannel', chaincode_name='substracc', **kwargs):
+    loop = asyncio.get_event_loop()
+    try:
+        return loop.run_until_complete(run_fixtures(cli, fixtures, channel_name, chaincode_name, **kwargs))
+    finally:
+        loop.run_until_complete(close_block_listeners())
+
+
+# Fixture files: {'fixtures': {name: fixture}}, fixtures being described as above except that
+#   args: plain data where a '$name' string stands for the key of fixture name, which is then a dependency
+#   deps: only needed for dependencies without reference in args
+#   default_from: field of the error message holding the key if the asset already exists ('tkey')
+#   count: the fixture is repeated count times as name[0]...name[count - 1], with '{i}' replaced by the index
+#          in its strings (args, references, deps, default), formatted with its spec if any ('{i:064x}'), e.g.
+#          'hash': '{i:064x}', 'dataManagerKeys': ['$datamanager[{i}]'], other braces are left as they are
+
+REFERENCE = re.compile(r'^\$(?P<name>.+)$')
+INDEX = re.compile(r'\{i(?::(?P<spec>[^{}]*))?\}')
+
+
+def map_strings(value, func):
+    if isinstance(value, str):
+        return func(value)
+    if isinstance(value, list):
+        return [map_strings(v, func) for v in value]
+    if isinstance(value, dict):
+        return {k: map_strings(v, func) for k, v in value.items()}
+    return value
+
+
+def references(value):
+    found = set()
+
+    def add(string):
+        match = REFERENCE.match(string)
+        if match:
+            found.add(match.group('name'))
+        return string
+
+    map_strings(value, add)
+    return found
+
+
+def resolve_references(value, keys):
+    return map_strings(value, lambda s: keys[REFERENCE.match(s).group('name')] if REFERENCE.match(s) else s)
+
+
+def expand_fixtures(fixtures):
+    expanded = {}
+
+    for name, fixture in fixtures.items():
+        if not isinstance(fixture, dict) or 'count' not in fixture:
+            expanded[name] = fixture
+            continue
+
+        fixture = dict(fixture)
+        count = fixture.pop('count')
+        if not isinstance(count, int) or count < 0:
+            raise FixtureError(f'{name}: count should be a positive integer, not {count}')
+
+        try:
+            for i in range(count):
+                expanded[f'{name}[{i}]'] = map_strings(
+                    fixture, lambda s: INDEX.sub(lambda m: format(i, m.group('spec') or ''), s))
+        except ValueError as e:
+            raise FixtureError(f'{name}: cannot format {e!r}')
+
+    return expanded
+
+
+def fixture_deps(fixture):
+    return sorted(set(fixture.get('deps', [])) | references(fixture.get('args')))
+
+
+def concurrent_objectives(fixtures, order):
+    # registering an objective sets the objective of its test data manager: objectives on the same data manager
+    # have to be registered one after the other, or the one ending up on it changes from run to run
+    ancestors = {}
+    for name in order:
+        ancestors[name] = set()
+        for dep in fixture_deps(fixtures[name]):
+            ancestors[name] |= {dep} | ancestors[dep]
+
+    errors = []
+    by_datamanager = {}
+    for name in order:
+        fixture = fixtures[name]
+        if fixture['fcn'] != 'registerObjective' or not isinstance(fixture['args'], dict):
+            continue
+        datamanager = (fixture['args'].get('testDataset') or {}).get('dataManagerKey')
+        for other in by_datamanager.get(datamanager, []):
+            if other not in ancestors[name]:
+                errors.append(f'{name}: registered concurrently with {other} on data manager {datamanager}, '
+                              f'one should depend on the other')
+        by_datamanager.setdefault(datamanager, []).append(name)
+
+    return errors
+
+
+def validate_fixtures(fixtures, orgs=None, peers=None):
+    errors = []
+
+    for name, fixture in fixtures.items():
+        if not isinstance(fixture, dict):
+            errors.append(f'{name}: not a mapping')
+            continue
+
+        for field in ('fcn', 'org', 'args'):
+            if field not in fixture:
+                errors.append(f'{name}: missing {field}')
+        if orgs is not None and fixture.get('org') not in orgs:
+            errors.append(f"{name}: unknown org {fixture.get('org')}")
+        if peers is not None and 'peer' in fixture and fixture['peer'] not in peers:
+            errors.append(f"{name}: unknown peer {fixture['peer']}")
+        if fixture.get('key') not in (None, 'key', 'keys'):
+            errors.append(f"{name}: key should be 'key' or 'keys', not {fixture['key']}")
+
+        for dep in fixture_deps(fixture):
+            if dep not in fixtures:
+                errors.append(f'{name}: unknown fixture {dep}')
+
+    if not errors:
+        try:
+            order = topological_order({name: (None, fixture_deps(fixture)) for name, fixture in fixtures.items()})
+        except DAGError as e:
+            errors.append(str(e))
+        else:
+            errors += concurrent_objectives(fixtures, order)
+
+    if errors:
+        raise FixtureError('Invalid fixtures:\n  ' + '\n  '.join(errors))
+
+
+def read_fixtures_file(path):
+    with open(path, 'r') as f:
+        if os.path.splitext(path)[1] == '.json':
+            data = json.load(f)
+        else:
+            data = load(f, Loader=FixturesLoader)
+
+    if not isinstance(data, dict) or not isinstance(data.get('fixtures'), dict):
+        raise FixtureError(f'{path}: expected a fixtures mapping')
+
+    return data['fixtures']
+
+
+def fixture_from_file(fixture):
+    fixture = dict(fixture)
+    file_args = fixture['args']
+    fixture['deps'] = fixture_deps(fixture)
+    fixture['args'] = lambda keys: resolve_references(file_args, keys)
+
+    if 'default_from' in fixture:
+        field = fixture.pop('default_from')
+        fixture['default'] = lambda response: tuple_key(response, field)
+
+    return fixture
+
+
+# The whole graph is validated before anything is submitted
+def prepare_fixtures(fixtures, orgs=None, peers=None):
+    fixtures = expand_fixtures(fixtures)
+    validate_fixtures(fixtures, orgs, peers)
+    return {name: fixture_from_file(fixture) for name, fixture in fixtures.items()}
+
+
+def load_fixtures_file(path, orgs=None, peers=None):
+    fixtures = prepare_fixtures(read_fixtures_file(path), orgs, peers)
+    print(f'Read {len(fixtures)} fixtures from {path}', flush=True)
+    return fixtures
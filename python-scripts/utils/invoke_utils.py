@@ -0,0 +1,308 @@
+# Copyright 2018 Owkin, inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter
+
+from hfc.fabric.block_decoder import decode_proposal_response_payload
+from hfc.fabric.transaction.tx_context import create_tx_context
+from hfc.fabric.transaction.tx_proposal_request import CC_INVOKE, CC_TYPE_GOLANG, create_tx_prop_req
+from hfc.util import utils
+
+from .cli import PEER_SELECTION, get_peer_selector
+from .config_utils import load_conf
+from .events_utils import close_block_listeners, get_block_listener
+
+# Validation codes of transactions invalidated because another one wrote what they read in between:
+# simulating them again on the new state is enough to get them committed
+RETRYABLE = ('MVCC_READ_CONFLICT', 'PHANTOM_READ_CONFLICT')
+
+MAX_RETRIES = int(os.getenv('INVOKE_MAX_RETRIES', 5))
+RETRY_DELAY = float(os.getenv('INVOKE_RETRY_DELAY', 0.5))
+RETRY_MAX_DELAY = float(os.getenv('INVOKE_RETRY_MAX_DELAY', 10))
+# retries allowed per invoke across all functions, so that a hot key does not turn into a retry storm
+RETRY_BUDGET = float(os.getenv('INVOKE_RETRY_BUDGET', 0.5))
+RETRY_BUDGET_MIN = int(os.getenv('INVOKE_RETRY_BUDGET_MIN', 10))
+INVOKE_TIMEOUT = float(os.getenv('INVOKE_TIMEOUT', 30))
+
+
+class BroadcastError(Exception):
+    pass
+
+
+class RetryStats(object):
+    # counters per chaincode function: invokes, retries, conflicts (per validation code), recovered, exhausted
+    def __init__(self):
+        self.counters = {}
+
+    def counter(self, fcn):
+        return self.counters.setdefault(fcn, Counter())
+
+    def count(self, fcn, *names):
+        counter = self.counter(fcn)
+        for name in names:
+            counter[name] += 1
+
+    def total(self, name):
+        return sum(counter[name] for counter in self.counters.values())
+
+    def budget_left(self, budget=RETRY_BUDGET, budget_min=RETRY_BUDGET_MIN):
+        return self.total('retries') < budget_min + budget * self.total('invokes')
+
+    def as_dict(self):
+        return {fcn: dict(counter) for fcn, counter in sorted(self.counters.items())}
+
+    def print(self):
+        for fcn, counter in sorted(self.counters.items()):
+            print(f"{fcn}: {counter['invokes']} invokes, {counter['retries']} retries "
+                  f"({counter['MVCC_READ_CONFLICT']} mvcc read conflicts, "
+                  f"{counter['PHANTOM_READ_CONFLICT']} phantom read conflicts), "
+                  f"{counter['recovered']} recovered, {counter['exhausted']} given up", flush=True)
+
+
+retry_stats = RetryStats()
+
+
+def backoff(attempt, delay=RETRY_DELAY, max_delay=RETRY_MAX_DELAY):
+    # full jitter, so that conflicting clients do not retry in lockstep and conflict again
+    return random.uniform(0, min(max_delay, delay * 2 ** attempt))
+
+
+async def send_proposal(cli, channel_name, tx_context, peers, selector=None):
+    responses, proposal, header = cli.get_channel(channel_name).send_tx_proposal(tx_context, peers)
+    if selector is not None:
+        responses = [selector.track([peer], response) for peer, response in zip(peers, responses)]
+    return peers, await asyncio.gather(*responses), proposal, header
+
+
+# Same as cli.chaincode_invoke(..., wait_for_event=True), returning the payload when the transaction is committed,
+# the validation code when the committing peers invalidate it and the message of the first endorsement when it is
+# not endorsed, but the commit is notified by the block listeners of the peers instead of a new event hub
+# connection per transaction, and a transaction the orderer refuses raises BroadcastError: it was endorsed but
+# never ordered, unlike a rejected one
+# Without peers, the endorsing peers are chosen by selector, and other ones when they cannot be reached
+async def chaincode_invoke(cli, requestor, channel_name, peers, fcn, args, cc_name, cc_type=CC_TYPE_GOLANG,
+                           transient_map=None, timeout=INVOKE_TIMEOUT, selector=None):
+    tx_prop_req = create_tx_prop_req(prop_type=CC_INVOKE, cc_name=cc_name, cc_type=cc_type, fcn=fcn, args=args,
+                                     transient_map=transient_map)
+    tx_context = create_tx_context(requestor, requestor.cryptoSuite, tx_prop_req)
+
+    if peers is None:
+        peers, responses, proposal, header = await selector.failover(
+            lambda peers: send_proposal(cli, channel_name, tx_context, peers, selector))
+    else:
+        peers = [cli.get_peer(peer) if isinstance(peer, str) else peer for peer in peers]
+        peers, responses, proposal, header = await send_proposal(cli, channel_name, tx_context, peers, selector)
+    if not all(response.response.status == 200 for response in responses):
+        return responses[0].response.message
+
+    # listening before the broadcast, the commit cannot be missed
+    listeners = await asyncio.wait_for(
+        asyncio.gather(*[get_block_listener(peer, channel_name, requestor) for peer in peers]), timeout)
+
+    tran_req = utils.build_tx_req((responses, proposal, header))
+    tx_context_tx = create_tx_context(requestor, requestor.cryptoSuite, tran_req)
+    async for response in utils.send_transaction(cli.orderers, tran_req, tx_context_tx):
+        if response.status != 200:
+            raise BroadcastError(f'{response.status}: {response.message}')
+
+    try:
+        codes = await asyncio.wait_for(
+            asyncio.gather(*[listener.wait_for_tx(tx_context.tx_id) for listener in listeners]), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError('waitForEvent timed out.')
+
+    for code in codes:
+        if code != 'VALID':
+            return code
+
+    payload = decode_proposal_response_payload(responses[0].payload)
+    return payload['extension']['response']['payload'].decode('utf-8')
+
+
+# Invoke the chaincode and wait for the commit of the transaction, but when the commit event says it has been
+# invalidated by a read conflict, propose it again (new simulation on the current state, new transaction id)
+# after a backoff, at most max_retries times and while the retry budget is not spent
+# Returns the response of the last attempt, the validation code if it still conflicts
+async def invoke(cli, requestor, channel_name, peers, fcn, args, cc_name, max_retries=MAX_RETRIES,
+                 stats=retry_stats, **kwargs):
+    stats.count(fcn, 'invokes')
+
+    attempt = 0
+    while True:
+        response = await chaincode_invoke(cli, requestor, channel_name, peers, fcn, args, cc_name, **kwargs)
+
+        if response not in RETRYABLE:
+            if attempt:
+                stats.count(fcn, 'recovered')
+            return response
+
+        stats.count(fcn, response)
+        if attempt == max_retries or not stats.budget_left():
+            stats.count(fcn, 'exhausted')
+            print(f'{fcn} still invalidated with {response} after {attempt} retries', flush=True)
+            return response
+
+        await asyncio.sleep(backoff(attempt))
+        attempt += 1
+        stats.count(fcn, 'retries')
+
+
+def chaincode_args(args):
+    # a dict is the json argument of the substra chaincode functions
+    if args is None or isinstance(args, list):
+        return args
+    return [json.dumps(args)]
+
+
+def decode_response(response):
+    try:
+        return json.loads(response)
+    except (TypeError, ValueError):
+        return response
+
+
+# the chaincode answers committed invokes with json, the message of a rejected endorsement is plain text
+def is_committed(response):
+    try:
+        json.loads(response)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class CallTimings(object):
+    # hook aggregating the duration of the calls per kind (query, invoke) and function
+    def __init__(self):
+        self.calls = {}
+
+    def __call__(self, kind, fcn, elapsed, error=None):
+        stats = self.calls.setdefault((kind, fcn), {'calls': 0, 'errors': 0, 'total': 0, 'max': 0})
+        stats['calls'] += 1
+        stats['errors'] += error is not None
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+
+    def print(self):
+        for (kind, fcn), stats in sorted(self.calls.items()):
+            print(f"{kind} {fcn}: {stats['calls']} calls, {stats['errors']} errors, "
+                  f"mean {stats['total'] / stats['calls']:.3f}s, max {stats['max']:.3f}s", flush=True)
+
+
+# Chaincode calls as a user of an org, on the channel and chaincode of its conf, all on the same event loop
+# query and invoke are coroutines, query_many and invoke_many run a list of calls concurrently, at most
+# max_concurrency at once; responses are decoded from json when they are
+# Every call is passed to the hooks as hook(kind, fcn, elapsed, error), timings aggregating them
+# Calls go to the given peers, or to the peers of the org chosen by a PeerSelector with the selection strategy
+class ChaincodeClient(object):
+    def __init__(self, cli, org_name, user_name='admin', peers=None, hooks=None, verbose=False,
+                 selection=PEER_SELECTION):
+        conf = load_conf(org_name)
+        self.cli = cli
+        self.org_name = org_name
+        self.channel_name = conf['misc']['channel_name']
+        self.chaincode_name = conf['misc']['chaincode_name']
+        self.requestor = cli.get_user(org_name, user_name)
+        self.peers = peers
+        self.selector = get_peer_selector(cli, [org_name], selection)
+        self.loop = asyncio.get_event_loop()
+        self.verbose = verbose
+        self.timings = CallTimings()
+        self.hooks = [self.timings] + list(hooks or [])
+
+        cli.new_channel(self.channel_name)
+
+    def get_peers(self, peers):
+        peers = peers or self.peers
+        if peers is None:
+            return None
+        return [self.cli.get_peer(peer) if isinstance(peer, str) else peer for peer in peers]
+
+    async def call(self, kind, fcn, coroutine, decode=True):
+        start = time.time()
+        error = None
+        try:
+            response = await coroutine
+            if decode:
+                response = decode_response(response)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.time() - start
+            for hook in self.hooks:
+                hook(kind, fcn, elapsed, error)
+            if self.verbose:
+                message = f'{kind} {fcn} on org {self.org_name} in {elapsed:.2f}s'
+                print(message if error is None else f'{message}: {error!r}', flush=True)
+
+        return response
+
+    # decode=False returns the raw response, e.g. to tell an empty result ('null') from an error message
+    async def query(self, fcn, args=None, peers=None, decode=True):
+        def query(peers):
+            return self.selector.track(peers, self.cli.chaincode_query(
+                requestor=self.requestor,
+                channel_name=self.channel_name,
+                peers=peers,
+                fcn=fcn,
+                args=chaincode_args(args),
+                cc_name=self.chaincode_name
+            ))
+
+        peers = self.get_peers(peers)
+        return await self.call('query', fcn, query(peers) if peers else self.selector.failover(query), decode)
+
+    # committed, retried on read conflicts
+    async def invoke(self, fcn, args=None, peers=None, **kwargs):
+        return await self.call('invoke', fcn, invoke(
+            self.cli,
+            requestor=self.requestor,
+            channel_name=self.channel_name,
+            peers=self.get_peers(peers),
+            fcn=fcn,
+            args=chaincode_args(args),
+            cc_name=self.chaincode_name,
+            selector=self.selector,
+            **kwargs
+        ))
+
+    async def many(self, method, calls, max_concurrency):
+        semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+        async def call(fcn, args=None, peers=None):
+            if semaphore is None:
+                return await method(fcn, args, peers)
+            async with semaphore:
+                return await method(fcn, args, peers)
+
+        return await asyncio.gather(*[call(*c) for c in calls])
+
+    # calls: [(fcn, args) or (fcn, args, peers)], returns the responses in the same order
+    async def query_many(self, calls, max_concurrency=None):
+        return await self.many(self.query, calls, max_concurrency)
+
+    async def invoke_many(self, calls, max_concurrency=None):
+        return await self.many(self.invoke, calls, max_concurrency)
+
+    # for scripts not running on the event loop
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        self.run(close_block_listeners())
@@ -17,10 +17,20 @@ import asyncio
 import json
 import os
 import random
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import call, check_output
 
-from hfc.util.policies import s2d
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from hfc.fabric.transaction.tx_context import TXContext
+from hfc.protos.common import common_pb2, configtx_pb2
+from hfc.util.utils import extract_channel_config
+
+from .chaincode_utils import get_chaincode_package
+from .cli import make_policy
+from .configtx_utils import compute_update_envelope, encode_config, encode_config_group
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -29,6 +39,10 @@ class ChannelAlreadyExist(Exception):
     pass
 
 
+class ChaincodeInstallError(Exception):
+    pass
+
+
 class Client(object):
 
     def __init__(self, cli, conf, conf_orderer):
@@ -91,77 +105,89 @@ class Client(object):
                                    ])
         return json.loads(org_config.decode('utf-8'))
 
-    def createUpdateProposal(self, conf, new_channel_config, old_channel_config):
+    def writeUpdateProposal(self, channel_name, original_config, updated_config):
+        # the sdk reads config updates from a configtx file
+        config_tx_file = 'proposal.pb'
+        with open(config_tx_file, 'wb') as f:
+            f.write(compute_update_envelope(channel_name, original_config, updated_config))
+        return config_tx_file
 
-        # Keep useful part
-        json.dump(old_channel_config, open('oldchannelconfig.json', 'w'))
+    def createUpdateProposal(self, conf, new_channel_config, old_channel_config):
+        old_config = encode_config(old_channel_config)
 
         # Add org
-        old_channel_config['channel_group']['groups']['Application']['groups'][conf['name']] = new_channel_config
-        json.dump(old_channel_config, open('newchannelconfig.json', 'w'))
-
-        # Compute diff
-        call(['configtxlator',
-              'proto_encode',
-              '--input', 'oldchannelconfig.json',
-              '--type', 'common.Config',
-              '--output', 'oldchannelconfig.pb'])
-
-        call(['configtxlator',
-              'proto_encode',
-              '--input', 'newchannelconfig.json',
-              '--type', 'common.Config',
-              '--output', 'newchannelconfig.pb'])
-
-        call(['configtxlator',
-              'compute_update',
-              '--channel_id', self.channel_name,
-              '--original', 'oldchannelconfig.pb',
-              '--updated', 'newchannelconfig.pb',
-              '--output', 'compute_update.pb'])
-
-        call(['configtxlator',
-              'proto_decode',
-              '--input', 'compute_update.pb',
-              '--type', 'common.ConfigUpdate',
-              '--output', 'compute_update.json'])
-
-        # Prepare proposal
-        update = json.load(open('compute_update.json', 'r'))
-        proposal = {'payload': {'header': {'channel_header': {'channel_id': self.channel_name,
-                                                              'type': 2}},
-                                'data': {'config_update': update}}}
-
-        json.dump(proposal, open('proposal.json', 'w'))
+        new_config = configtx_pb2.Config()
+        new_config.CopyFrom(old_config)
+        new_config.channel_group.groups['Application'].groups[conf['name']].CopyFrom(
+            encode_config_group(new_channel_config))
 
-        config_tx_file = 'proposal.pb'
-        call(['configtxlator',
-              'proto_encode',
-              '--input', 'proposal.json',
-              '--type', 'common.Envelope',
-              '--output', config_tx_file])
-        return config_tx_file
+        return self.writeUpdateProposal(self.channel_name, old_config, new_config)
+
+    def signConfig(self, org_admin, config):
+        # same as hfc Client.sign_channel_config, without sharing the cli tx_context between threads
+        tx_context = TXContext(org_admin, org_admin.cryptoSuite, {})
+
+        signature_header = common_pb2.SignatureHeader(creator=tx_context.identity, nonce=tx_context.nonce)
+        signature_header_bytes = signature_header.SerializeToString()
+
+        return configtx_pb2.ConfigSignature(signature_header=signature_header_bytes,
+                                            signature=tx_context.sign(signature_header_bytes + config))
+
+    def verifyConfigSignature(self, org_admin, config, signature):
+        cert = x509.load_pem_x509_certificate(org_admin.enrollment.cert, default_backend())
+        return org_admin.cryptoSuite.verify(cert.public_key(),
+                                            signature.signature_header + config,
+                                            signature.signature)
+
+    def timedSignConfig(self, org_name, org_admin, config):
+        start = time.time()
+        signature = self.signConfig(org_admin, config)
+        return org_name, signature, time.time() - start
+
+    async def gatherConfigSignatures(self, org_admins, config):
+        if not org_admins:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(org_admins), 32)) as executor:
+            return await asyncio.gather(*[
+                self.loop.run_in_executor(executor, self.timedSignConfig, org_name, org_admin, config)
+                for org_name, org_admin in org_admins.items()])
 
     def signAndPushUpdateProposal(self, conf_externals, config_tx_file):
-        signatures = []
-        for conf in conf_externals:
-            # Sign
-            print(f"Sign update proposal on {conf['name']} ...", flush=True)
+        # the config update bytes channel_update extracts again from config_tx_file, signatures have to match them
+        # (Client.extract_channel_config reads a ConfigUpdate field that does not exist)
+        with open(config_tx_file, 'rb') as f:
+            config = extract_channel_config(f.read())
 
-            org_admin = self.cli.get_user(conf['name'], conf['users']['admin']['name'])
+        org_admins = {conf['name']: self.cli.get_user(conf['name'], conf['users']['admin']['name'])
+                      for conf in conf_externals}
 
-            signature = self.cli.channel_signconfigtx(config_tx_file, org_admin)
-            signatures.append(signature)
-        else:
-            # Push with last one
-            print(f"Send update proposal with org: {conf['name']}...", flush=True)
+        # Push with last one, channel_update adds its own signature
+        pusher = conf_externals[-1]['name']
+        signers = {org_name: org_admin for org_name, org_admin in org_admins.items() if org_name != pusher}
 
-            self.loop.run_until_complete(self.cli.channel_update(
-                self.orderer,
-                self.channel_name,
-                org_admin,
-                config_tx=config_tx_file,
-                signatures=signatures))
+        print(f"Sign update proposal on {list(signers)} ...", flush=True)
+        results = self.loop.run_until_complete(self.gatherConfigSignatures(signers, config))
+
+        timings = {}
+        for org_name, signature, duration in results:
+            if not self.verifyConfigSignature(org_admins[org_name], config, signature):
+                raise Exception(f'Invalid update proposal signature from {org_name}')
+            print(f"Signed update proposal on {org_name} in {duration:.3f}s", flush=True)
+            timings[org_name] = duration
+
+        print(f"Send update proposal with org: {pusher}...", flush=True)
+
+        start = time.time()
+        self.loop.run_until_complete(self.cli.channel_update(
+            self.orderer,
+            self.channel_name,
+            org_admins[pusher],
+            config_tx=config_tx_file,
+            signatures=[signature.SerializeToString() for _, signature, _ in results]))
+        timings[pusher] = time.time() - start
+
+        return timings
 
     def generateChannelUpdate(self, conf, conf_externals, old_channel_config):
         new_channel_config = self.createChannelConfig()
@@ -182,7 +208,7 @@ class Client(object):
         }
 
         config_tx_file = self.createUpdateProposal(conf, new_channel_config, old_channel_config)
-        self.signAndPushUpdateProposal(conf_externals, config_tx_file)
+        return self.signAndPushUpdateProposal(conf_externals, config_tx_file)
 
     # the updater of the channel anchor transaction must have admin rights for one of the consortium orgs
     # Update the anchor peers
@@ -194,22 +220,58 @@ class Client(object):
             self.org_admin,
             config_tx=self.config_tx))
 
-    def installChainCodeOnPeers(self, conf, chaincode_version):
+    def packageChainCode(self):
+        # content addressed: reused across orgs, runs and version bumps without source changes
+        return get_chaincode_package(self.chaincode_path)
+
+    async def installChainCodeOnPeer(self, org_admin, org_name, peer_name, chaincode_version, packaged_cc, semaphore):
+        async with semaphore:
+            start = time.time()
+            try:
+                responses = await self.cli.chaincode_install(
+                    requestor=org_admin,
+                    peers=[peer_name],
+                    cc_path=self.chaincode_path,
+                    cc_name=self.chaincode_name,
+                    cc_version=chaincode_version,
+                    packaged_cc=packaged_cc)
+            except Exception as e:
+                status, message = None, str(e)
+            else:
+                status, message = responses[0].response.status, responses[0].response.message
+
+        return peer_name, {'org': org_name, 'status': status, 'message': message, 'duration': time.time() - start}
+
+    def installChainCodeOnOrgs(self, confs, chaincode_version, max_concurrency=8):
+        packaged_cc = self.packageChainCode()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        installs = []
+        for conf in confs:
+            org_admin = self.cli.get_user(conf['name'], conf['users']['admin']['name'])
+            installs += [self.installChainCodeOnPeer(org_admin, conf['name'], peer['name'],
+                                                     chaincode_version, packaged_cc, semaphore)
+                         for peer in conf['peers']]
 
-        org_admin = self.cli.get_user(conf['name'], conf['users']['admin']['name'])
-        peers = [x['name'] for x in conf['peers']]
+        print(f"Installing chaincode on {[peer['name'] for conf in confs for peer in conf['peers']]} ...", flush=True)
 
-        print(f"Installing chaincode on {peers} ...", flush=True)
+        results = dict(self.loop.run_until_complete(asyncio.gather(*installs)))
 
-        kwargs = {
-            'requestor': org_admin,
-            'peers': peers,
-            'cc_path': self.chaincode_path,
-            'cc_name': self.chaincode_name,
-            'cc_version': chaincode_version,
-        }
+        for peer_name, result in results.items():
+            print(f"Installed chaincode on {peer_name} in {result['duration']:.3f}s "
+                  f"with status {result['status']}: {result['message']}", flush=True)
+
+        # a peer with the same chaincode version installed already answers that it exists, which is fine,
+        # any other answer or no answer at all (status None) is not
+        failed = {peer_name: result['message'] for peer_name, result in results.items()
+                  if result['status'] != 200 and (result['status'] is None or 'exists' not in result['message'])}
+        if failed:
+            raise ChaincodeInstallError(f'Could not install chaincode on {sorted(failed)}: {failed}')
+
+        return results
 
-        self.loop.run_until_complete(self.cli.chaincode_install(**kwargs))
+    def installChainCodeOnPeers(self, conf, chaincode_version):
+        return self.installChainCodeOnOrgs([conf], chaincode_version)
 
     def getChaincodeVersion(self, conf):
         org_admin = self.cli.get_user(conf['name'], conf['users']['admin']['name'])
@@ -229,11 +291,10 @@ class Client(object):
             raise Exception(f'Could not find valid chaincode version, expected version: "{self.chaincode_name}"')
 
     def makePolicy(self, orgs_mspid):
-        roles =[f"'{x}.member'" for x in orgs_mspid]
-        policy = f"OR({', '.join(roles)})"
+        policy = make_policy(orgs_mspid)
         print('policy: ', policy, flush=True)
 
-        return s2d().parse(policy)
+        return policy
 
     def instanciateChaincode(self, args=None):
 
@@ -293,50 +354,15 @@ class Client(object):
         system_channel_config_envelope = self.getChannelConfigBlockWithOrderer(self.system_channel_name)
         system_channel_config = system_channel_config_envelope['config']
 
-        json.dump(system_channel_config, open('system_channelconfig.json', 'w'))
-        call(['configtxlator',
-              'proto_encode',
-              '--input', 'system_channelconfig.json',
-              '--type', 'common.Config',
-              '--output', 'systemchannelold.block'])
+        old_config = encode_config(system_channel_config)
 
         # Update useful part
-        system_channel_config['channel_group']['groups']['Consortiums']['groups']['SampleConsortium']['groups'][
-            self.org._name] = org_config
-        json.dump(system_channel_config, open('system_channelconfig.json', 'w'))
-        call(['configtxlator',
-              'proto_encode',
-              '--input', 'system_channelconfig.json',
-              '--type', 'common.Config',
-              '--output', 'systemchannelupdate.block'])
-
-        # Compute update
-        call(f'configtxlator compute_update --channel_id {self.system_channel_name}'
-             f' --original systemchannelold.block'
-             f' --updated systemchannelupdate.block'
-             f' | '
-             f'configtxlator proto_decode --type common.ConfigUpdate'
-             f' --output compute_update.json',
-             shell=True)
-
-        # Prepare proposal
-        update = json.load(open('compute_update.json', 'r'))
-
-        proposal = {'payload': {'header': {'channel_header': {'channel_id': self.system_channel_name,
-                                                              'type': 2}},
-                                'data': {'config_update': update}}}
-
-        json.dump(proposal, open('proposal.json', 'w'))
-
-        config_tx_file = 'proposal.pb'
+        new_config = configtx_pb2.Config()
+        new_config.CopyFrom(old_config)
+        new_config.channel_group.groups['Consortiums'].groups['SampleConsortium'].groups[self.org._name].CopyFrom(
+            encode_config_group(org_config))
 
-        call(['configtxlator',
-              'proto_encode',
-              '--input', 'proposal.json',
-              '--type', 'common.Envelope',
-              '--output', config_tx_file])
-
-        return config_tx_file
+        return self.writeUpdateProposal(self.system_channel_name, old_config, new_config)
 
     def getChannelConfigBlockWithOrderer(self, channel_name):
         print('Will getChannelConfigBlockWithOrderer', flush=True)
@@ -12,12 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from shutil import copytree
 from subprocess import call
 
-from hfc.fabric_ca.caservice import ca_service
-from cryptography.hazmat.primitives.asymmetric import rsa
+import requests
+from requests.adapters import HTTPAdapter
+from hfc.fabric_ca.caservice import ca_service, CAClient
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography import x509
@@ -27,6 +33,72 @@ from cryptography.hazmat.primitives import hashes
 
 from .common_utils import waitPort, dowait
 
+CA_MAX_WORKERS = int(os.getenv('CA_MAX_WORKERS', 8))
+
+# same semantic as fabric-ca csr.keyrequest
+DEFAULT_KEY_REQUEST = {'algo': 'ecdsa', 'size': 256}
+ECDSA_CURVES = {256: ec.SECP256R1, 384: ec.SECP384R1, 521: ec.SECP521R1}
+
+# keys generated ahead of time in worker processes, by (algo, size)
+key_pool = None
+pregenerated_keys = {}
+pregenerated_keys_lock = threading.Lock()
+
+# one ca service per fabric-ca server, shared by all the registrations and enrollments
+ca_services = {}
+ca_services_lock = threading.Lock()
+
+
+class CASessionClient(CAClient):
+    # Send requests through a keep-alive session instead of opening a new connection (and tls handshake) each time
+    def __init__(self, *args, pool_size=CA_MAX_WORKERS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def _send(self, method, path, **param):
+        r = self._session.request(method, self._base_url + path, **param)
+        return r.json(), r.status_code
+
+    def _send_ca_post(self, path, **param):
+        return self._send('POST', path, **param)
+
+    def _send_ca_get(self, path, **param):
+        return self._send('GET', path, **param)
+
+    def _send_ca_delete(self, path, **param):
+        return self._send('DELETE', path, **param)
+
+    def _send_ca_update(self, path, **param):
+        return self._send('PUT', path, **param)
+
+
+def getCAService(org):
+    target = f"https://{org['ca']['host']}:{org['ca']['port']['internal']}"
+
+    with ca_services_lock:
+        if target not in ca_services:
+            cacli = ca_service(target=target,
+                               ca_certs_path=org['ca']['certfile']['internal'],
+                               ca_name=org['ca']['name'])
+            cacli._ca_client = CASessionClient(target,
+                                               org['ca']['certfile']['internal'],
+                                               ca_name=org['ca']['name'],
+                                               cryptoPrimitives=cacli._crypto)
+            ca_services[target] = cacli
+
+    return ca_services[target]
+
+
+# Run calls concurrently with a bounded pool, return their results in order
+def runBatch(funcs, max_workers=CA_MAX_WORKERS):
+    if not funcs:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(funcs))) as executor:
+        futures = [executor.submit(func) for func in funcs]
+        return [future.result() for future in futures]
+
 
 def removeIntermediateCerts(intermediatecerts_dir):
     print(f'Delete intermediate certs in {intermediatecerts_dir}', flush=True)
@@ -77,53 +149,45 @@ def configLocalMSP(org, user_name):
 
 def enrollCABootstrapAdmin(org):
 
-    waitPort(f"{org['ca']['name']} to start",
-             90,
-             org['ca']['logfile'],
-             org['ca']['host'],
-             org['ca']['port']['internal'])
+    if not waitPort(f"{org['ca']['name']} to start",
+                    90,
+                    org['ca']['logfile'],
+                    org['ca']['host'],
+                    org['ca']['port']['internal']):
+        raise Exception(f"{org['ca']['name']} is not listening, see {org['ca']['logfile']}")
     print(f"Enrolling with {org['ca']['name']} as bootstrap identity ...", flush=True)
 
     # enroll booststrap admin
-    target = f"https://{org['ca']['host']}:{org['ca']['port']['internal']}"
-    cacli = ca_service(target=target,
-                       ca_certs_path=org['ca']['certfile']['internal'],
-                       ca_name=org['ca']['name'])
+    cacli = getCAService(org)
     bootstrap_admin = cacli.enroll(org['ca']['users']['bootstrap_admin']['name'],
                                    org['ca']['users']['bootstrap_admin']['pass'])
     return bootstrap_admin
 
 
+def registerIdentity(badmin, org, name, password, role=None, attrs=None):
+    print(f"Registering {name} with {org['ca']['name']}", flush=True)
+    return badmin.register(name, password, role, maxEnrollments=-1, attrs=attrs)
+
+
 def registerOrdererIdentities(org):
     badmin = enrollCABootstrapAdmin(org)
 
-    for orderer in org['orderers']:
-        print(
-            f"Registering {orderer['name']} with {org['ca']['name']}", flush=True)
-        badmin.register(orderer['name'], orderer['pass'],
-                        'orderer', maxEnrollments=-1)
+    identities = [(orderer['name'], orderer['pass'], 'orderer') for orderer in org['orderers']]
 
     if 'peers' in org:
-        for peer in org['peers']:
-            print(
-                f"Registering {peer['name']} with {org['ca']['name']}\n", flush=True)
-            badmin.register(peer['name'], peer['pass'],
-                            'peer', maxEnrollments=-1)
+        identities += [(peer['name'], peer['pass'], 'peer') for peer in org['peers']]
 
-    print(f"Registering admin identity with {org['ca']['name']}", flush=True)
     attrs = [{'name': 'admin', 'value': 'true:ecert'}]
-    badmin.register(org['users']['admin']['name'], org['users']
-                    ['admin']['pass'], maxEnrollments=-1, attrs=attrs)
+    identities.append((org['users']['admin']['name'], org['users']['admin']['pass'], None, attrs))
+
+    runBatch([lambda identity=identity: registerIdentity(badmin, org, *identity) for identity in identities])
 
 
 def registerPeerIdentities(org):
     badmin = enrollCABootstrapAdmin(org)
-    for peer in org['peers']:
-        print(
-            f"Registering {peer['name']} with {org['ca']['name']}\n", flush=True)
-        badmin.register(peer['name'], peer['pass'], 'peer', maxEnrollments=-1)
 
-    print(f"Registering admin identity with {org['ca']['name']}", flush=True)
+    identities = [(peer['name'], peer['pass'], 'peer') for peer in org['peers']]
+
     # The admin identity has the "admin" attribute which is added to ECert by default
     attrs = [
         {'name': 'hf.Registrar.Roles', 'value': 'client'},
@@ -133,13 +197,12 @@ def registerPeerIdentities(org):
         {'name': 'admin', 'value': 'true:ecert'},
         {'name': 'abac.init', 'value': 'true:ecert'}
     ]
-    badmin.register(org['users']['admin']['name'], org['users']
-                    ['admin']['pass'], maxEnrollments=-1, attrs=attrs)
+    identities.append((org['users']['admin']['name'], org['users']['admin']['pass'], None, attrs))
 
-    print(f"Registering user identity with {org['ca']['name']}\n", flush=True)
     if 'user' in org['users']:
-        badmin.register(org['users']['user']['name'],
-                        org['users']['user']['pass'], maxEnrollments=-1)
+        identities.append((org['users']['user']['name'], org['users']['user']['pass']))
+
+    runBatch([lambda identity=identity: registerIdentity(badmin, org, *identity) for identity in identities])
 
 
 def registerIdentities(conf):
@@ -179,10 +242,15 @@ def registerUsers(conf):
     return enrollmentAdmin
 
 
+# Write to a temporary file first so that a crash never leaves a half written key or cert
 def writeFile(filename, content):
     os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, 'wb') as f:
+    tmp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_filename, 'wb') as f:
         f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
 
 
 def saveMSP(msp_dir, enrollment, admincerts=False):
@@ -209,10 +277,7 @@ def saveMSP(msp_dir, enrollment, admincerts=False):
 
 
 def enrollWithFiles(user, org, msp_dir, csr=None, profile='', attr_reqs=None, admincerts=False):
-    target = f"https://{org['ca']['host']}:{org['ca']['port']['internal']}"
-    cacli = ca_service(target=target,
-                       ca_certs_path=org['ca']['certfile']['internal'],
-                       ca_name=org['ca']['name'])
+    cacli = getCAService(org)
     enrollment = cacli.enroll(user['name'],
                               user['pass'],
                               csr=csr,
@@ -224,12 +289,86 @@ def enrollWithFiles(user, org, msp_dir, csr=None, profile='', attr_reqs=None, ad
     return enrollment
 
 
+def keyAlgorithm(org):
+    keyrequest = org['csr'].get('keyrequest') or DEFAULT_KEY_REQUEST
+    algo = keyrequest.get('algo', 'ecdsa')
+    return algo, keyrequest.get('size', 256 if algo == 'ecdsa' else 2048)
+
+
+def generatePrivateKey(algo, size):
+    if algo == 'ecdsa':
+        return ec.generate_private_key(ECDSA_CURVES[size](), default_backend())
+    if algo == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=size, backend=default_backend())
+    raise ValueError(f'Unsupported key algorithm: {algo}')
+
+
+# keys cannot be pickled, workers send them back as pem
+def generatePrivateKeyBytes(algo, size):
+    return generatePrivateKey(algo, size).private_bytes(encoding=serialization.Encoding.PEM,
+                                                        format=serialization.PrivateFormat.PKCS8,
+                                                        encryption_algorithm=serialization.NoEncryption())
+
+
+# Start generating count keys in background processes, to overlap with the ca requests
+def pregenerateKeys(org, count, max_workers=None):
+    global key_pool
+
+    algorithm = keyAlgorithm(org)
+    # an ecdsa key is generated faster than it is sent back by another process
+    if algorithm[0] != 'rsa':
+        return
+
+    with pregenerated_keys_lock:
+        if key_pool is None:
+            key_pool = ProcessPoolExecutor(max_workers)
+            atexit.register(shutdownKeyPool)
+        pregenerated_keys.setdefault(algorithm, deque()).extend(
+            key_pool.submit(generatePrivateKeyBytes, *algorithm) for _ in range(count))
+
+
+# Stop the workers, dropping the keys not generated yet
+def shutdownKeyPool():
+    global key_pool
+
+    with pregenerated_keys_lock:
+        pool, key_pool = key_pool, None
+        futures = [future for keys in pregenerated_keys.values() for future in keys]
+        pregenerated_keys.clear()
+
+    for future in futures:
+        future.cancel()
+    if pool is not None:
+        pool.shutdown()
+
+
+def getPrivateKey(org):
+    global key_pool
+
+    algorithm = keyAlgorithm(org)
+
+    with pregenerated_keys_lock:
+        future = pregenerated_keys[algorithm].popleft() if pregenerated_keys.get(algorithm) else None
+
+    if future is None:
+        return generatePrivateKey(*algorithm)
+
+    key = serialization.load_pem_private_key(future.result(), password=None, backend=default_backend())
+
+    # the workers are not needed anymore once every pregenerated key has been used
+    with pregenerated_keys_lock:
+        pool = None
+        if key_pool is not None and not any(pregenerated_keys.values()):
+            pool, key_pool = key_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+    return key
+
+
 def genTLSCert(node, org, cert_file, key_file, ca_file):
     # Generate our key
-    pkey = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-        backend=default_backend())
+    pkey = getPrivateKey(org)
 
     name = org['csr']['names'][0]
     # Generate a CSR
@@ -250,10 +389,7 @@ def genTLSCert(node, org, cert_file, key_file, ca_file):
         # Sign the CSR with our private key.
     ).sign(pkey, hashes.SHA256(), default_backend())
 
-    target = f"https://{org['ca']['host']}:{org['ca']['port']['internal']}"
-    cacli = ca_service(target=target,
-                       ca_certs_path=org['ca']['certfile']['internal'],
-                       ca_name=org['ca']['name'])
+    cacli = getCAService(org)
     enrollment = cacli.enroll(
         node['name'], node['pass'], csr=csr, profile='tls')
 
@@ -12,17 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+import asyncio
 import json
 import time
-import sys
-
-import substra
+from concurrent.futures import ThreadPoolExecutor
 
+from utils.cli import init_cli
+from utils.config_utils import load_conf
+from utils.events_utils import block_writes
 
 USER, PASSWORD = ('admin', 'admin')
-client = substra.Client()
-client.add_profile('owkin', 'http://owkin.substra-backend:8000', '0.0',
-                   user=USER, password=PASSWORD)
+
+TERMINAL = ('done', 'failed')
+
+# keys per list request, and list requests in flight
+CHUNK_SIZE = 100
+MAX_WORKERS = 8
+MIN_INTERVAL, MAX_INTERVAL = 1, 30
 
 
 def load_tuple_keys(path):
@@ -31,40 +38,180 @@ def load_tuple_keys(path):
     return (data['traintupleKeys'], data['testtupleKeys'])
 
 
-def watch_tuples(traintuple_keys, testtuple_keys):
-    # watch all tuples until they are in done/failed state
-    print(f'Watching traintuple keys: {traintuple_keys}')
-    print(f'Watching testtuple keys: {testtuple_keys}')
+class TupleIndex(object):
+    # last known status of the watched tuples
+    def __init__(self, traintuple_keys, testtuple_keys):
+        self.types = {key: 'traintuple' for key in traintuple_keys}
+        self.types.update({key: 'testtuple' for key in testtuple_keys})
+        self.statuses = {}
+
+    def update(self, key, status):
+        if key not in self.types or self.statuses.get(key) in TERMINAL:
+            return
+
+        if status != self.statuses.get(key):
+            print(f'{self.types[key]} {status}: {key}', flush=True)
+        self.statuses[key] = status
+
+    def pending(self):
+        return [key for key in self.types if self.statuses.get(key) not in TERMINAL]
+
+    def failed(self):
+        return [key for key in self.types if self.statuses.get(key) == 'failed']
+
+    def progress(self):
+        statuses = [self.statuses.get(key) for key in self.types]
+        done, failed = statuses.count('done'), statuses.count('failed')
+        return {'done': done, 'failed': failed, 'pending': len(statuses) - done - failed}
 
-    failed = False
 
-    conf = (
-        ('traintuple', traintuple_keys, client.list_traintuple),
-        ('testtuple', testtuple_keys, client.list_testtuple)
-    )
+def chunks(keys, size):
+    return [keys[i:i + size] for i in range(0, len(keys), size)]
 
-    while traintuple_keys and testtuple_keys:
-        for tuple_type, tuple_keys, list_tuple in conf:
-            tuple_filter = [f'{tuple_type}:key:{key}' for key in tuple_keys]
-            tuples = list_tuple(filters=tuple_filter)
 
-            for tuple_ in tuples:
-                if tuple_['status'] == 'failed':
-                    print(f'{tuple_type} failed: {tuple_["key"]}')
-                    failed = True
-                if tuple_['status'] in ('done', 'failed'):
-                    print(f'{tuple_type} done: {tuple_["key"]}')
-                    tuple_keys.remove(tuple_['key'])
+class PollInterval(object):
+    # poll often while tuples complete, back off while nothing happens
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.min = min_interval
+        self.max = max_interval
+        self.value = min_interval
 
-        time.sleep(2)
+    def update(self, completed):
+        if completed:
+            self.value = max(self.min, self.value / 2)
+        else:
+            self.value = min(self.max, self.value * 1.5)
+        return self.value
+
+
+# Poll the statuses of the tuples not done or failed yet, in chunks of chunk_size keys listed concurrently,
+# printing a json progress line after each round
+def watch_tuples(traintuple_keys, testtuple_keys, chunk_size=CHUNK_SIZE, max_workers=MAX_WORKERS,
+                 min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    import substra
+
+    client = substra.Client()
+    client.add_profile('owkin', 'http://owkin.substra-backend:8000', '0.0',
+                       user=USER, password=PASSWORD)
+
+    # watch all tuples until they are in done/failed state
+    print(f'Watching {len(traintuple_keys)} traintuples and {len(testtuple_keys)} testtuples', flush=True)
+
+    index = TupleIndex(traintuple_keys, testtuple_keys)
+    list_tuples = {'traintuple': client.list_traintuple, 'testtuple': client.list_testtuple}
+    interval = PollInterval(min_interval, max_interval)
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while index.pending():
+            pending = index.pending()
+            finished = len(index.types) - len(pending)
+
+            futures = []
+            for tuple_type, list_tuple in list_tuples.items():
+                keys = [key for key in pending if index.types[key] == tuple_type]
+                for chunk in chunks(keys, chunk_size):
+                    futures.append(executor.submit(list_tuple, filters=[f'{tuple_type}:key:{key}' for key in chunk]))
+
+            for future in futures:
+                for tuple_ in future.result():
+                    index.update(tuple_['key'], tuple_['status'])
+
+            progress = index.progress()
+            completed = progress['done'] + progress['failed'] - finished
+            elapsed = time.time() - start
+            rate = (progress['done'] + progress['failed']) / elapsed
+            progress.update({
+                'elapsed': round(elapsed, 1),
+                'requests': len(futures),
+                'rate': round(rate, 3),
+                'eta': round(progress['pending'] / rate, 1) if rate else None,
+            })
+            print(json.dumps(progress), flush=True)
+
+            if index.pending():
+                time.sleep(interval.update(completed))
+
+    if index.failed():
+        raise ValueError("At least one of the tuples failed")
+
+    print('All traintuples and testtuples reached the "done" status')
+
+
+# Instead of polling the backends, follow the blocks committed on a peer: the status of a tuple changes when
+# a transaction writes it in the ledger, so the index is updated from the writes of each block and the watch
+# returns with the block making the last tuple done or failed
+async def watch_tuples_events(traintuple_keys, testtuple_keys, org_name, peer_name, timeout=None):
+    print(f'Watching traintuple keys: {traintuple_keys}')
+    print(f'Watching testtuple keys: {testtuple_keys}')
 
-    if failed:
+    cli = init_cli()
+    org = load_conf(org_name)
+    channel_name = org['misc']['channel_name']
+    chaincode_name = org['misc']['chaincode_name']
+    channel = cli.new_channel(channel_name)
+    requestor = cli.get_user(org_name, 'admin')
+    peer = cli.get_peer(peer_name)
+
+    index = TupleIndex(traintuple_keys, testtuple_keys)
+
+    # current statuses, then every block from this height on
+    info = await cli.query_info(requestor, channel_name, [peer])
+    for fcn in ('queryTraintuples', 'queryTesttuples'):
+        response = await cli.chaincode_query(requestor, channel_name, [peer], [], chaincode_name, fcn=fcn)
+        for tuple_ in json.loads(response) or []:
+            index.update(tuple_['key'], tuple_['status'])
+
+    if index.pending():
+        channel_event_hub = channel.newChannelEventHub(peer, requestor)
+
+        def on_block(block):
+            for _, key, is_delete, value in block_writes(block, chaincode_name):
+                if key in index.types and not is_delete:
+                    try:
+                        index.update(key, json.loads(value)['status'])
+                    except (TypeError, ValueError, KeyError):
+                        pass
+
+            # no registration left: the event hub stops reading blocks
+            if not index.pending():
+                channel_event_hub.unregisterBlockEvent(registration)
+
+        registration = channel_event_hub.registerBlockEvent(unregister=False, onEvent=on_block)
+        stream = channel_event_hub.connect(filtered=False, start=info.height)
+        try:
+            await asyncio.wait_for(stream, timeout)
+        finally:
+            channel_event_hub.disconnect()
+
+    if index.pending():
+        raise ValueError(f'The peer closed the block stream with {len(index.pending())} tuples still running')
+    if index.failed():
         raise ValueError("At least one of the tuples failed")
 
-    print(f'All traintuples and testtuples reached the "done" status')
+    print('All traintuples and testtuples reached the "done" status')
 
 
 if __name__ == '__main__':
-    path = sys.argv.pop()
-    traintuple_keys, testtuple_keys = load_tuple_keys(path)
-    watch_tuples(traintuple_keys, testtuple_keys)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='json file with the traintupleKeys and testtupleKeys to watch')
+    parser.add_argument('--events', action='store_true', default=False,
+                        help='follow the blocks committed on a peer instead of polling the backend')
+    parser.add_argument('--org', type=str, default='owkin', help='org of the admin reading the blocks')
+    parser.add_argument('--peer', type=str, default=None, help='peer to read the blocks from, default: peer1-<org>')
+    parser.add_argument('--timeout', type=float, default=None, help='give up after this many seconds')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='tuple keys per list request')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS, help='list requests in flight')
+    parser.add_argument('--min-interval', type=float, default=MIN_INTERVAL, help='minimum seconds between polls')
+    parser.add_argument('--max-interval', type=float, default=MAX_INTERVAL, help='maximum seconds between polls')
+    args = vars(parser.parse_args())
+
+    traintuple_keys, testtuple_keys = load_tuple_keys(args['path'])
+
+    if args['events']:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(watch_tuples_events(traintuple_keys, testtuple_keys, args['org'],
+                                                    args['peer'] or f"peer1-{args['org']}", args['timeout']))
+    else:
+        watch_tuples(traintuple_keys, testtuple_keys, args['chunk_size'], args['max_workers'],
+                     args['min_interval'], args['max_interval'])